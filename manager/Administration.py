@@ -7,20 +7,51 @@ __email__ = "contact@vultureproject.org"
 __doc__ = 'The unix socket administration server class'
 
 import socket
+import selectors
 import logging
 import redis
 import os
+from threading import Thread, Lock, Condition
+from itertools import count
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from JsonSocket import JsonSocket
-from time import sleep
+from UpdateJob import UpdateJob
+from Subscription import Subscription
+from MetricsServer import MetricsServer
+from StatsHistory import StatsHistory
+from time import sleep, time
 import json
+from config import manager_settings
 
 logger = logging.getLogger()
 
 class Server:
     """
     Manages administration connections for filter update and monitoring.
+
+    Connections are served concurrently by a pool of workers, so that read-only commands
+    are answered while long lifecycle commands run. Each lifecycle command runs on its own
+    executor, bounding how many of them can run at the same time.
+
+    A connection whose first command carries an 'id' is kept open as a session:
+    the client can pipeline commands on it, each one being answered as soon as it is processed
+    with {"id": <id of the command>, "response": <response>}, possibly out of order.
+    The sessions are read by a single thread, their commands running on the same workers and executors,
+    and at most 'admin_max_sessions' of them are open at the same time.
     """
 
+    # Maximum number of concurrent executions of the lifecycle commands
+    COMMAND_LIMITS = {
+        'update_filters': 1
+    }
+    LISTEN_BACKLOG = 128
+    # Number of ended update jobs kept for the 'job_status' and 'job_wait' commands
+    MAX_ENDED_JOBS = 100
+    JOB_WAIT_DEFAULT_TIMEOUT = 30
+    # Threads sending the stats to the subscribed clients
+    SUBSCRIPTION_SENDERS = 2
+
     def __init__(self, prefix, suffix):
         """
         Constructor. Create the UNIX socket to listen on.
@@ -32,8 +63,28 @@ class Server:
         self._socket_path = '{}/sockets{}/darwin.sock'.format(prefix, suffix)
         self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self._socket.bind(self._socket_path)
-        self._socket.listen(5)
+        self._socket.listen(self.LISTEN_BACKLOG)
         self._socket.settimeout(1)
+        self._workers = None
+        self._command_executors = {}
+        # Open sessions: file descriptor -> [client JsonSocket, time of the last command]
+        self._sessions = {}
+        self._sessions_lock = Lock()
+        self._sessions_selector = selectors.DefaultSelector()
+        self._jobs = OrderedDict()
+        self._jobs_lock = Lock()
+        # Pending 'job_wait' commands: wait number -> (deadline, job, reply function)
+        self._job_waits = {}
+        self._job_waits_cv = Condition()
+        self._job_wait_numbers = count()
+        self._subscriptions = {}
+        self._subscriptions_lock = Lock()
+        # Condition the reporter waits on, set when it starts
+        self._stats_cv = None
+        self._services = None
+        self._metrics = None
+        # Stats history, created by the reporter when enabled
+        self._history = None
 
     def __del__(self):
         """
@@ -51,32 +102,194 @@ class Server:
         :param cmd: The instruction sent by the client.
         """
         response = {}
-        if cmd.get('type', None):
-            if cmd['type'] == 'update_filters':
-                errors = services.update(cmd.get('filters', []), self._prefix, self._suffix)
-                errors += self.update_stats_conf()
-                if not errors:
-                    response['status'] = 'OK'
-                else:
-                    response['status'] = 'KO'
-                    response['errors'] = errors
-            elif cmd['type'] == 'monitor':
-                response = services.monitor_all(proc_stats=cmd.get('proc_stats', []))
+        subscription = None
+        try:
+            if cmd.get('type', None):
+                if cmd['type'] == 'update_filters' and cmd.get('async', False):
+                    job = self.submit_update_job(services, cmd.get('filters', []))
+                    response = {'status': 'OK', 'job': job.id}
+                elif cmd['type'] == 'update_filters':
+                    timings = {}
+                    errors = services.update(cmd.get('filters', []), self._prefix, self._suffix, timings=timings)
+                    errors += self.update_stats_conf()
+                    if not errors:
+                        response['status'] = 'OK'
+                    else:
+                        response['status'] = 'KO'
+                        response['errors'] = errors
+                    response['timings'] = timings
+                elif cmd['type'] == 'monitor':
+                    response = services.monitor_all(proc_stats=cmd.get('proc_stats', []),
+                                                   max_age_ms=cmd.get('max_age_ms', 0),
+                                                   filters=cmd.get('filters'), fields=cmd.get('fields'))
+                elif cmd['type'] == 'history':
+                    if self._history is None:
+                        response = {'status': 'KO', 'errors': ['Stats history disabled']}
+                    else:
+                        response = self._history.query(cmd.get('filters'), cmd.get('metrics'), cmd.get('start'),
+                                                       cmd.get('end'), cmd.get('step'))
+                elif cmd['type'] == 'startup_traces':
+                    response = services.startup_traces(cmd.get('filters', []))
+                elif cmd['type'] == 'subscribe':
+                    subscription = Subscription(cli, cmd.get('interval', 1), time(), filters=cmd.get('filters'),
+                                                fields=cmd.get('fields'), request_id=cmd.get('id'))
+                    response = {'status': 'OK', 'subscription': subscription.id, 'interval': subscription.interval}
+                elif cmd['type'] == 'unsubscribe':
+                    if self.unsubscribe(cmd.get('subscription')):
+                        response = {'status': 'OK'}
+                    else:
+                        response = {'status': 'KO', 'errors': ['Subscription not existing']}
+                elif cmd['type'] in ('job_status', 'job_wait'):
+                    with self._jobs_lock:
+                        job = self._jobs.get(cmd.get('job'))
+                    if job is None:
+                        response = {'status': 'KO', 'errors': ['Job not existing']}
+                    elif cmd['type'] == 'job_wait' and not job.done:
+                        # Answered when the job ends or the wait times out, without holding a worker
+                        self._wait_job(cli, cmd, job)
+                        return
+                    else:
+                        response = job.to_dict()
+        except Exception as e:
+            logger.error("Error processing admin command {}: {}".format(cmd.get('type'), e))
+            response = {'status': 'KO', 'errors': [str(e)]}
+
+        # The acknowledgement of a subscription is the first line of the stream
+        if not self._reply(cli, cmd, response, line=subscription is not None):
+            return
+
+        # The stream starts once the subscription is acknowledged
+        if subscription:
+            self.subscribe(subscription)
+
+    @staticmethod
+    def _reply(cli, cmd, response, line=False):
+        """
+        Send the response to a command, wrapped with the id of the command if it has one.
+
+        :param cli: The client JsonSocket.
+        :param cmd: The command.
+        :param response: The response.
+        :param line: If set to True, the response is sent as a line of JSON.
+        :return: True if the response was sent, False otherwise.
+        """
+        if 'id' in cmd:
+            response = {'id': cmd['id'], 'response': response}
 
         try:
-            cli.send(response)
-            del cli
+            if line:
+                cli.send_line(response)
+            else:
+                cli.send(response)
         except Exception as e:
             logger.error("Error sending admin a response: {0}".format(e))
+            return False
+        return True
+
+    def _wait_job(self, cli, cmd, job):
+        """
+        Answer a 'job_wait' command when the job ends, or with its current state once the wait times out.
+
+        :param cli: The client JsonSocket.
+        :param cmd: The 'job_wait' command.
+        :param job: The UpdateJob object.
+        """
+        number = next(self._job_wait_numbers)
+
+        def reply(job):
+            # Called once the job ends and once the wait times out, the first call answers
+            with self._job_waits_cv:
+                if self._job_waits.pop(number, None) is None:
+                    return
+            self._reply(cli, cmd, job.to_dict())
+
+        with self._job_waits_cv:
+            self._job_waits[number] = (time() + cmd.get('timeout', self.JOB_WAIT_DEFAULT_TIMEOUT), job, reply)
+            self._job_waits_cv.notify()
+        job.add_done_callback(reply)
+
+    def expire_job_waits(self):
+        """
+        Answer the 'job_wait' commands whose timeout expired, until the server stops.
+        """
+        while self._continue:
+            with self._job_waits_cv:
+                now = time()
+                expired = [(job, reply) for deadline, job, reply in self._job_waits.values() if deadline <= now]
+                if not expired:
+                    deadlines = [deadline for deadline, _, _ in self._job_waits.values()]
+                    self._job_waits_cv.wait(min([now + 1] + deadlines) - now)
+                    continue
+            for job, reply in expired:
+                reply(job)
+
+    def subscribe(self, subscription):
+        """
+        Register a stats subscription and wake up the reporter to push its first stats.
+
+        :param subscription: The Subscription object.
+        """
+        with self._subscriptions_lock:
+            self._subscriptions[subscription.id] = subscription
+        logger.info("Stats subscription {} registered".format(subscription.id))
+        cv = self._stats_cv
+        if cv:
+            with cv:
+                cv.notify_all()
+
+    def unsubscribe(self, subscription_id):
+        """
+        Remove a stats subscription.
+
+        :param subscription_id: The id of the subscription.
+        :return: True if the subscription existed, False otherwise.
+        """
+        with self._subscriptions_lock:
+            return self._subscriptions.pop(subscription_id, None) is not None
+
+    def submit_update_job(self, services, names):
+        """
+        Schedule an update of the filters on the executor of the 'update_filters' command.
+
+        :param services: The services manager.
+        :param names: The names of the filters to update.
+        :return: The UpdateJob object.
+        """
+        job = UpdateJob(names)
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+            ended = [i for i, j in self._jobs.items() if j.done]
+            for i in ended[:max(len(ended) - self.MAX_ENDED_JOBS, 0)]:
+                del self._jobs[i]
+        self._command_executors['update_filters'].submit(self._run_update_job, services, job)
+        return job
+
+    def _run_update_job(self, services, job):
+        job.start()
+        timings = {}
+        try:
+            errors = services.update(job.names, self._prefix, self._suffix, timings=timings, progress=job.progress)
+            errors += self.update_stats_conf()
+        except Exception as e:
+            logger.error("Error running update job {}: {}".format(job.id, e))
+            errors = [{"error": str(e)}]
+        job.finish(errors, timings)
 
     def run(self, services):
         """
         Accept connections on the administration socket,
-        receive the incoming commands and process them.
+        and hand them to the workers pool.
         """
+        self._workers = ThreadPoolExecutor(max_workers=manager_settings.get('admin_workers', 8))
+        self._command_executors = {
+            command: ThreadPoolExecutor(max_workers=limit) for command, limit in self.COMMAND_LIMITS.items()
+        }
+
+        Thread(target=self.expire_job_waits, name="JobWaits", daemon=True).start()
+        Thread(target=self.serve_sessions, name="AdminSessions", daemon=True).start()
+
         self.running = True
         while self._continue:
-            cli = None
             try:
                 _cli, _ = self._socket.accept()
             except socket.timeout:
@@ -85,24 +298,183 @@ class Server:
                 logger.error("Error accepting admin connection: {0}".format(e))
                 continue
 
-            try:
-                cli = JsonSocket(_cli)
-                cmd = cli.recv()
-            except json.JSONDecodeError as e:
-                logger.error("Error decoding message from admin: {}".format(e))
+            self._workers.submit(self.handle, services, _cli)
+
+        self._workers.shutdown(wait=False)
+        for executor in self._command_executors.values():
+            executor.shutdown(wait=False)
+        self.update_metrics(None)
+
+    def handle(self, services, _cli):
+        """
+        Receive the first command of an admin connection and process it.
+        If the command carries an 'id', the connection goes on as a session.
+
+        :param services: The services manager.
+        :param _cli: The accepted client socket.
+        """
+        cli = JsonSocket(_cli)
+        cmd = self._receive(cli)
+        if cmd is None:
+            return
+
+        with self._sessions_lock:
+            opened = len(self._sessions) < manager_settings.get('admin_max_sessions', 64)
+
+        if 'id' not in cmd:
+            self._dispatch(services, cli, cmd, inline=True)
+            # Keep reading a subscription connection, to receive its 'unsubscribe' command
+            if cmd.get('type') == 'subscribe' and opened:
+                self._open_session(services, cli)
+            return
+
+        if not opened:
+            logger.warning("Too many admin sessions, refusing a new one")
+            self._reply(cli, cmd, {'status': 'KO', 'errors': ['Too many sessions']})
+            return
+
+        self._dispatch(services, cli, cmd)
+        self._open_session(services, cli)
+
+    def _open_session(self, services, cli):
+        """
+        Keep receiving the commands of a connection in the sessions thread.
+
+        :param services: The services manager.
+        :param cli: The client JsonSocket.
+        """
+        logger.debug("Admin session opened")
+        try:
+            # Commands pipelined behind the first one may already be received
+            for cmd in cli.buffered():
+                self._dispatch(services, cli, cmd)
+        except Exception as e:
+            logger.error("Error receiving data from admin: {0}".format(e))
+            return
+
+        with self._sessions_lock:
+            self._sessions[cli.fileno()] = [cli, time()]
+            self._sessions_selector.register(cli, selectors.EVENT_READ, services)
+
+    def serve_sessions(self):
+        """
+        Receive the commands pipelined on the sessions, and dispatch them to the workers,
+        until the client closes the connection or stays idle for 'admin_idle_timeout' seconds
+        without any subscription.
+        """
+        idle_timeout = manager_settings.get('admin_idle_timeout', 300)
+        while self._continue:
+            for key, _ in self._sessions_selector.select(timeout=1):
+                cli, services = key.fileobj, key.data
                 try:
-                    cli.send({
-                        'status': 'KO',
-                        'errors': [str(e)]
-                    })
+                    commands = cli.recv_available()
+                except json.JSONDecodeError as e:
+                    logger.error("Error decoding message from admin: {}".format(e))
+                    self._reject(cli, str(e))
+                    self._close_session(cli)
+                    continue
                 except Exception as e:
-                    logger.critical("Error while trying to reply to admin: {}".format(e))
-                continue
-            except Exception as e:
-                logger.error("Error receiving data from admin: {0}".format(e))
-                continue
+                    logger.debug("Admin session closed: {}".format(e))
+                    self._close_session(cli)
+                    continue
+
+                with self._sessions_lock:
+                    self._sessions[cli.fileno()][1] = time()
+                for cmd in commands:
+                    self._dispatch(services, cli, cmd)
+
+            now = time()
+            with self._subscriptions_lock:
+                subscribed = [s.cli for s in self._subscriptions.values()]
+            with self._sessions_lock:
+                idle = [c for c, last in self._sessions.values()
+                        if now - last > idle_timeout and not any(c is s for s in subscribed)]
+            for cli in idle:
+                logger.debug("Admin session idle for too long, closing")
+                self._close_session(cli)
+
+    def _close_session(self, cli):
+        with self._sessions_lock:
+            if self._sessions.pop(cli.fileno(), None) is not None:
+                self._sessions_selector.unregister(cli)
+        # The subscriptions of the connection end with it
+        with self._subscriptions_lock:
+            for subscription_id in [i for i, s in self._subscriptions.items() if s.cli is cli]:
+                del self._subscriptions[subscription_id]
+
+    def _receive(self, cli):
+        """
+        Receive a command from an admin connection, replying with an error if it cannot be decoded.
+
+        :param cli: The client JsonSocket.
+        :return: The command, None if no command can be received anymore.
+        """
+        try:
+            cmd = cli.recv()
+        except json.JSONDecodeError as e:
+            logger.error("Error decoding message from admin: {}".format(e))
+            Server._reject(cli, str(e))
+        except Exception as e:
+            logger.error("Error receiving data from admin: {0}".format(e))
+        else:
+            if Server._valid_command(cli, cmd):
+                return cmd
+        return None
 
+    @staticmethod
+    def _reject(cli, error):
+        """
+        Reply with an error to a message that is not a valid command.
+
+        :param cli: The client JsonSocket.
+        :param error: The error message.
+        """
+        try:
+            cli.send({
+                'status': 'KO',
+                'errors': [error]
+            })
+        except Exception as e:
+            logger.critical("Error while trying to reply to admin: {}".format(e))
+
+    @staticmethod
+    def _valid_command(cli, cmd):
+        """
+        Check that a decoded message is a command object, replying with an error otherwise.
+
+        :param cli: The client JsonSocket.
+        :param cmd: The decoded message.
+        :return: True if the message is a command, False otherwise.
+        """
+        if isinstance(cmd, dict):
+            return True
+        logger.error("Invalid message from admin: expected a JSON object, got {}".format(type(cmd).__name__))
+        Server._reject(cli, 'Invalid command: expected a JSON object')
+        return False
+
+    def _dispatch(self, services, cli, cmd, inline=False):
+        """
+        Process a command on the executor of the command if its concurrency is limited,
+        on the workers pool otherwise.
+
+        :param services: The services manager.
+        :param cli: The client JsonSocket.
+        :param cmd: The command to process.
+        :param inline: If set to True, commands without concurrency limit are processed in the calling thread.
+        """
+        # The messages pipelined on a session are only decoded
+        if not Server._valid_command(cli, cmd):
+            return
+        # Asynchronous updates only schedule a job, which runs on the executor of the command
+        executor = None if cmd.get('async', False) else self._command_executors.get(cmd.get('type'))
+        if executor is None and inline:
             self.process(services, cli, cmd)
+            return
+        try:
+            (executor or self._workers).submit(self.process, services, cli, cmd)
+        except RuntimeError:
+            # The server is stopping
+            pass
 
     def stop(self):
         """
@@ -113,7 +485,15 @@ class Server:
     def constant_heartbeat(self, services, cv):
         """
         Run constant heartbeat in a thread.
+        When the filters are supervised, wait for their processes to exit instead.
         """
+        supervisor = services.supervisor
+        if supervisor:
+            logger.info("HeartBeat: filters are supervised, watching process exits")
+            while self._continue:
+                supervisor.poll(1)
+            logger.debug("HeartBeat: stopping")
+            return
 
         with cv:
             while self._continue:
@@ -157,6 +537,31 @@ class Server:
 
         return error
 
+    def update_metrics(self, metrics_conf):
+        """
+        Start, restart or stop the metrics endpoint according to its configuration.
+
+        :param metrics_conf: The 'metrics' configuration, None to stop the endpoint.
+        :return: An error message, empty on success.
+        """
+        if self._metrics and self._metrics.conf == metrics_conf:
+            return ""
+        if self._metrics:
+            self._metrics.stop()
+            self._metrics = None
+        if not metrics_conf:
+            return ""
+
+        metrics = MetricsServer(self._services, metrics_conf)
+        try:
+            metrics.start()
+        except OSError as e:
+            error = "Could not serve metrics: {}".format(e)
+            logger.error(error)
+            return error
+        self._metrics = metrics
+        return ""
+
     def update_stats_conf(self):
         self._stats_redis = None
         self._stats_filepath = None
@@ -171,44 +576,93 @@ class Server:
             error = self.try_open_file(file_conf)
             if error:
                 errors.append({"configuration": "report_stats", "error": error})
+        if self._services:
+            error = self.update_metrics(self._stats.get('metrics', None))
+            if error:
+                errors.append({"configuration": "report_stats", "error": error})
 
         return errors
 
     def report_stats(self, services, reports_conf, cv):
         """
-        Run stats reporting at regular intervals
+        Run stats reporting at regular intervals,
+        push the stats to the subscribed clients when their interval is due,
+        and sample the stats history every 'history_interval' seconds.
+        A single collection serves the report and all the subscribers due at the same time.
+        The condition shared with the heartbeat is only held while waiting, and the stats are sent
+        to the subscribers by a small executor, so that slow clients do not delay the reports and the heartbeat.
         """
 
         self._stats = reports_conf
+        self._services = services
         self.update_stats_conf()
+        self._stats_cv = cv
 
-        with cv:
-            while self._continue:
-                cv.wait(self._stats.get('interval', 10))
-                if not self._continue:
-                    logger.debug("Reporter: stopping")
-                    break
-                stats = json.dumps(services.monitor_all())
-                logger.debug("reporting stats: {}".format(stats))
-
-                if self._stats_redis:
-                    try:
-                        redis_pub = self._stats['redis'].get('channel', None)
-                        redis_list = self._stats['redis'].get('list', None)
-                        if redis_pub:
-                            logger.debug("Reporting stats on Redis channel {}".format(redis_pub))
-                            self._stats_redis.publish(redis_pub, stats.encode("ascii"))
-                        if redis_list:
-                            logger.debug("Reporting stats on Redis list {}".format(redis_list))
-                            self._stats_redis.rpush(redis_list, stats.encode("ascii"))
-                    except redis.exceptions.ConnectionError as e:
-                        logger.error("Could not report stats to Redis: {}".format(e))
-
-                if self._stats_filepath:
-                    try:
-                        logger.debug("Reporting stats to file {}".format(self._stats_filepath))
-                        os.umask(0)
-                        with open(os.open(self._stats_filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, int(self._stats_file_permissions, 8)), 'a') as file:
-                            file.write(stats+'\n')
-                    except Exception as e:
-                        logger.error("Could not write stats to file: {}".format(e))
+        history_interval = manager_settings.get('history_interval', 10)
+        if history_interval > 0:
+            self._history = StatsHistory(manager_settings.get('history_size', 2160))
+
+        senders = ThreadPoolExecutor(max_workers=self.SUBSCRIPTION_SENDERS)
+        next_report = time() + self._stats.get('interval', 10)
+        next_sample = time() if self._history else float('inf')
+        while self._continue:
+            with self._subscriptions_lock:
+                subscriptions = list(self._subscriptions.values())
+            due = min([next_report, next_sample] + [s.next_due for s in subscriptions])
+            with cv:
+                cv.wait(max(due - time(), 0))
+            if not self._continue:
+                logger.debug("Reporter: stopping")
+                break
+
+            now = time()
+            subscriptions = [s for s in subscriptions if s.next_due <= now]
+            if subscriptions:
+                data = services.monitor_all()
+                for subscription in subscriptions:
+                    if not subscription.push(data, now, senders):
+                        self.unsubscribe(subscription.id)
+
+            collected = bool(subscriptions)
+            if now >= next_sample:
+                next_sample = max(next_sample + history_interval, now)
+                self._history.record(services.monitor_all(max_age_ms=1000 if collected else 0), now)
+                collected = True
+
+            if now >= next_report:
+                next_report = now + self._stats.get('interval', 10)
+                # Served from the collection of the subscribers or of the history when they were due
+                self._report(json.dumps(services.monitor_all(startup_traces=True,
+                                                             max_age_ms=1000 if collected else 0)))
+
+        senders.shutdown(wait=False)
+
+    def _report(self, stats):
+        """
+        Report the stats to the configured Redis and file outputs.
+
+        :param stats: The JSON formatted stats.
+        """
+        logger.debug("reporting stats: {}".format(stats))
+
+        if self._stats_redis:
+            try:
+                redis_pub = self._stats['redis'].get('channel', None)
+                redis_list = self._stats['redis'].get('list', None)
+                if redis_pub:
+                    logger.debug("Reporting stats on Redis channel {}".format(redis_pub))
+                    self._stats_redis.publish(redis_pub, stats.encode("ascii"))
+                if redis_list:
+                    logger.debug("Reporting stats on Redis list {}".format(redis_list))
+                    self._stats_redis.rpush(redis_list, stats.encode("ascii"))
+            except redis.exceptions.ConnectionError as e:
+                logger.error("Could not report stats to Redis: {}".format(e))
+
+        if self._stats_filepath:
+            try:
+                logger.debug("Reporting stats to file {}".format(self._stats_filepath))
+                os.umask(0)
+                with open(os.open(self._stats_filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, int(self._stats_file_permissions, 8)), 'a') as file:
+                    file.write(stats+'\n')
+            except Exception as e:
+                logger.error("Could not write stats to file: {}".format(e))
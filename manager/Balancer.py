@@ -0,0 +1,298 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Unix socket load balancer for multi-instance filters'
+
+import errno
+import logging
+import os
+import socket
+import selectors
+from threading import Thread
+
+logger = logging.getLogger()
+
+
+class _Connection:
+    """
+    A client connection forwarded to a filter instance.
+    """
+
+    def __init__(self, client, backends):
+        self.sockets = {'client': client, 'upstream': None}
+        self.backend = None
+        # Instances left to try if the connection to the current one fails
+        self.backends = backends
+        self.connecting = False
+        # Data waiting to be written to each side
+        self.buffers = {'client': bytearray(), 'upstream': bytearray()}
+        self.registered = {'client': False, 'upstream': False}
+        # Whether each side reached EOF, and whether writing to each side was shut down
+        self.eof = {'client': False, 'upstream': False}
+        self.shut = {'client': False, 'upstream': False}
+        self.closed = False
+
+
+class Balancer:
+    """
+    Listen on the socket of a multi-instance filter, and forward each incoming
+    connection to one of the filter instances, in a single selector loop.
+
+    The instance is chosen either in turn ('round_robin'), or as the one currently
+    handling the fewest forwarded connections ('least_connections').
+
+    All the sockets are non-blocking. When a side reaches EOF, writing to the other one is shut down
+    once the data waiting for it is written, and the connection is closed once both directions are shut down.
+    """
+
+    BUFFER_SIZE = 65536
+    # Stop reading from a side while this much data is waiting to be written to the other
+    MAX_PENDING = 4 * BUFFER_SIZE
+
+    def __init__(self, name, socket_path, backends, policy='round_robin'):
+        """
+        Constructor.
+
+        :param name: The name of the filter.
+        :param socket_path: The path of the socket to listen on.
+        :param backends: Callable returning the list of the socket paths of the running instances.
+        :param policy: The balancing policy, 'round_robin' or 'least_connections'.
+        """
+        self._name = name
+        self._socket_path = socket_path
+        self._backends = backends
+        self._policy = policy
+        self._next = 0
+        self._active = {}
+        self._selector = selectors.DefaultSelector()
+        self._listener = None
+        self._thread = None
+        self._running = False
+
+    @property
+    def socket_path(self):
+        return self._socket_path
+
+    def start(self):
+        """
+        Bind the filter socket and start forwarding connections in a thread.
+        """
+        if os.path.lexists(self._socket_path):
+            os.remove(self._socket_path)
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self._socket_path)
+        self._listener.listen(128)
+        self._listener.setblocking(False)
+        self._selector.register(self._listener, selectors.EVENT_READ)
+
+        self._running = True
+        self._thread = Thread(target=self._run, name="Balancer-{}".format(self._name), daemon=True)
+        self._thread.start()
+        logger.info("Balancer: forwarding connections of filter {} ({})".format(self._name, self._policy))
+
+    def stop(self):
+        """
+        Stop forwarding, close all the connections and remove the filter socket.
+        """
+        self._running = False
+        if self._thread:
+            self._thread.join(2)
+            self._thread = None
+
+        for key in list(self._selector.get_map().values()):
+            if key.data:
+                self._close(key.data)
+        if self._listener:
+            self._selector.unregister(self._listener)
+            self._listener.close()
+            self._listener = None
+        self._selector.close()
+
+        try:
+            os.remove(self._socket_path)
+        except FileNotFoundError:
+            pass
+
+    def connections(self):
+        """
+        Get the number of forwarded connections per instance socket.
+
+        :return: A dict associating instance socket paths to their number of connections.
+        """
+        return dict(self._active)
+
+    def _choose(self):
+        backends = self._backends()
+        if not backends:
+            return []
+
+        if self._policy == 'least_connections':
+            return sorted(backends, key=lambda b: self._active.get(b, 0))
+
+        self._next = (self._next + 1) % len(backends)
+        return backends[self._next:] + backends[:self._next]
+
+    def _run(self):
+        while self._running:
+            for key, mask in self._selector.select(timeout=1):
+                if key.data is None:
+                    self._accept()
+                else:
+                    self._handle(key, mask)
+
+    def _accept(self):
+        try:
+            client, _ = self._listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.error("Balancer: error accepting connection on filter {}: {}".format(self._name, e))
+            return
+
+        client.setblocking(False)
+        conn = _Connection(client, self._choose())
+        if self._connect(conn):
+            self._update(conn)
+
+    def _connect(self, conn):
+        """
+        Start connecting to the next instance to try, without blocking.
+
+        :return: False if no instance is left to try, the connection being closed, True otherwise.
+        """
+        while conn.backends:
+            backend = conn.backends.pop(0)
+            upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            upstream.setblocking(False)
+            error = upstream.connect_ex(backend)
+            if error not in (0, errno.EINPROGRESS):
+                # On Unix sockets, EAGAIN means the listen backlog of the instance is full
+                logger.warning("Balancer: cannot connect to instance {} of filter {}: {}".format(
+                    backend, self._name, os.strerror(error)))
+                upstream.close()
+                continue
+
+            conn.sockets['upstream'] = upstream
+            conn.backend = backend
+            conn.connecting = error == errno.EINPROGRESS
+            self._active[backend] = self._active.get(backend, 0) + 1
+            return True
+
+        logger.error("Balancer: no instance of filter {} available, dropping connection".format(self._name))
+        self._close(conn)
+        return False
+
+    def _connected(self, conn):
+        """
+        Complete the connection to the instance once its socket is writable, trying the next instance on failure.
+
+        :return: False if the connection was closed, True otherwise.
+        """
+        upstream = conn.sockets['upstream']
+        error = upstream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if not error:
+            conn.connecting = False
+            return True
+
+        logger.warning("Balancer: cannot connect to instance {} of filter {}: {}".format(
+            conn.backend, self._name, os.strerror(error)))
+        if conn.registered['upstream']:
+            self._selector.unregister(upstream)
+            conn.registered['upstream'] = False
+        upstream.close()
+        self._active[conn.backend] = max(self._active.get(conn.backend, 1) - 1, 0)
+        conn.sockets['upstream'] = None
+        conn.backend = None
+        return self._connect(conn)
+
+    def _handle(self, key, mask):
+        conn, side = key.data
+        other = 'upstream' if side == 'client' else 'client'
+        sock = conn.sockets[side]
+
+        if side == 'upstream' and conn.connecting:
+            if mask & selectors.EVENT_WRITE and self._connected(conn):
+                self._update(conn)
+            return
+
+        if mask & selectors.EVENT_READ:
+            try:
+                data = sock.recv(self.BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                self._close(conn)
+                return
+
+            if data == b'':
+                conn.eof[side] = True
+            elif data:
+                conn.buffers[other] += data
+
+        if mask & selectors.EVENT_WRITE and conn.buffers[side]:
+            try:
+                sent = sock.send(conn.buffers[side])
+                del conn.buffers[side][:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self._close(conn)
+                return
+
+        # Forward the EOF of each side once the data it sent is written to the other one
+        for closed, peer in [('client', 'upstream'), ('upstream', 'client')]:
+            if conn.eof[closed] and not conn.buffers[peer] and not conn.shut[peer]:
+                try:
+                    conn.sockets[peer].shutdown(socket.SHUT_WR)
+                except OSError:
+                    self._close(conn)
+                    return
+                conn.shut[peer] = True
+        if conn.shut['client'] and conn.shut['upstream']:
+            self._close(conn)
+            return
+
+        self._update(conn)
+
+    def _update(self, conn):
+        """
+        Register each side of the connection for the events it currently needs.
+        """
+        for side, other in [('client', 'upstream'), ('upstream', 'client')]:
+            events = 0
+            if side == 'upstream' and conn.connecting:
+                events = selectors.EVENT_WRITE
+            else:
+                if not conn.eof[side] and len(conn.buffers[other]) < self.MAX_PENDING:
+                    events |= selectors.EVENT_READ
+                if conn.buffers[side]:
+                    events |= selectors.EVENT_WRITE
+
+            sock = conn.sockets[side]
+            if events and conn.registered[side]:
+                self._selector.modify(sock, events, (conn, side))
+            elif events:
+                self._selector.register(sock, events, (conn, side))
+                conn.registered[side] = True
+            elif conn.registered[side]:
+                self._selector.unregister(sock)
+                conn.registered[side] = False
+
+    def _close(self, data):
+        conn = data[0] if isinstance(data, tuple) else data
+        if conn.closed:
+            return
+        conn.closed = True
+        if conn.backend:
+            self._active[conn.backend] = max(self._active.get(conn.backend, 1) - 1, 0)
+        for side, sock in conn.sockets.items():
+            if sock is None:
+                continue
+            if conn.registered[side]:
+                self._selector.unregister(sock)
+                conn.registered[side] = False
+            sock.close()
@@ -0,0 +1,147 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'cgroup v2 resource isolation of the filters'
+
+import logging
+import os
+
+logger = logging.getLogger()
+
+
+class Cgroup:
+    """
+    Put each filter instance in its own cgroup v2, under a root managed by the manager,
+    apply its resource limits and collect its pressure and throttling counters.
+    """
+
+    # Filter configuration fields and their cgroup interface files
+    LIMITS = {
+        'cpu_max': 'cpu.max',
+        'memory_high': 'memory.high',
+        'memory_max': 'memory.max'
+    }
+    PRESSURE_FILES = ['cpu.pressure', 'memory.pressure', 'io.pressure']
+    STAT_FILES = {
+        'cpu.stat': ['nr_periods', 'nr_throttled', 'throttled_usec'],
+        'memory.events': ['high', 'max', 'oom', 'oom_kill']
+    }
+
+    @staticmethod
+    def setup_root(root):
+        """
+        Create the root cgroup of the filters and enable the cpu and memory controllers for its children.
+
+        :param root: The path of the root cgroup.
+        :return: True on success, False otherwise.
+        """
+        try:
+            os.makedirs(root, exist_ok=True)
+            with open(os.path.join(root, 'cgroup.subtree_control'), 'w') as f:
+                f.write('+cpu +memory')
+        except OSError as e:
+            logger.error("Cgroup: cannot set up root cgroup {}: {}".format(root, e))
+            return False
+        return True
+
+    @staticmethod
+    def path(root, filter):
+        """
+        Get the cgroup path of a filter instance.
+
+        :param root: The path of the root cgroup.
+        :param filter: The dict of the filter instance.
+        :return: The path of the cgroup.
+        """
+        return os.path.join(root, '{}{}'.format(filter['name'], filter.get('extension', '')))
+
+    @staticmethod
+    def attach(root, filter, pid):
+        """
+        Create the cgroup of a filter instance, apply its limits and move its process into it.
+
+        :param root: The path of the root cgroup.
+        :param filter: The dict of the filter instance.
+        :param pid: The pid of the filter process.
+        """
+        path = Cgroup.path(root, filter)
+        try:
+            os.makedirs(path, exist_ok=True)
+            for setting, interface in Cgroup.LIMITS.items():
+                if setting in filter:
+                    with open(os.path.join(path, interface), 'w') as f:
+                        f.write(str(filter[setting]))
+            with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                f.write(str(pid))
+        except OSError as e:
+            logger.error("Cgroup: cannot attach filter {} to {}: {}".format(filter['name'], path, e))
+            return
+        logger.debug("Cgroup: filter {} (pid {}) attached to {}".format(filter['name'], pid, path))
+
+    @staticmethod
+    def remove(root, filter):
+        """
+        Remove the cgroup of a stopped filter instance.
+
+        :param root: The path of the root cgroup.
+        :param filter: The dict of the filter instance.
+        """
+        path = Cgroup.path(root, filter)
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Cgroup: cannot remove {}: {}".format(path, e))
+
+    @staticmethod
+    def _parse_pressure(content):
+        """
+        Parse a PSI file, formatted as lines like 'some avg10=0.00 avg60=0.00 avg300=0.00 total=0'.
+        """
+        pressure = {}
+        for line in content.splitlines():
+            fields = line.split()
+            if not fields:
+                continue
+            pressure[fields[0]] = {k: float(v) if '.' in v else int(v)
+                                   for k, v in (field.split('=', 1) for field in fields[1:])}
+        return pressure
+
+    @staticmethod
+    def stats(root, filter):
+        """
+        Get the pressure stall information and the throttling counters of a filter instance.
+
+        :param root: The path of the root cgroup.
+        :param filter: The dict of the filter instance.
+        :return: A dict containing the available counters.
+        """
+        path = Cgroup.path(root, filter)
+        stats = {}
+
+        for interface in Cgroup.PRESSURE_FILES:
+            try:
+                with open(os.path.join(path, interface)) as f:
+                    stats[interface] = Cgroup._parse_pressure(f.read())
+            except (OSError, ValueError):
+                pass
+
+        for interface, keys in Cgroup.STAT_FILES.items():
+            try:
+                with open(os.path.join(path, interface)) as f:
+                    values = dict(line.split() for line in f if line.strip())
+                stats[interface] = {k: int(values[k]) for k in keys if k in values}
+            except (OSError, ValueError):
+                pass
+
+        try:
+            with open(os.path.join(path, 'memory.current')) as f:
+                stats['memory.current'] = int(f.read())
+        except (OSError, ValueError):
+            pass
+
+        return stats
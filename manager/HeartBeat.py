@@ -6,7 +6,24 @@ __maintainer__ = "Vulture Project"
 __email__ = "contact@vultureproject.org"
 __doc__ = 'The heartbeat functions and main class'
 
+import os
+import select
+import ctypes
+import ctypes.util
+import psutil
 from os import kill, access, F_OK
+from time import sleep, time
+
+# pidfd_open(2) syscall number, used when os.pidfd_open is not available (Python < 3.9).
+# It is 434 on the architectures using the generic syscall table, but not on all of them (544 on alpha),
+# so it is only called on the architectures known to use it.
+SYS_pidfd_open = 434
+SYS_pidfd_open_MACHINES = ['x86_64', 'aarch64']
+
+try:
+    _syscall = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).syscall
+except (OSError, AttributeError, TypeError):
+    _syscall = None
 
 
 class HeartBeat:
@@ -41,6 +58,8 @@ class HeartBeat:
     def check_process(pid):
         """
         Check if the process is currently running.
+        An exited process not reaped yet (a zombie) can still be signaled, but is not running:
+        it is reaped if it is a child of the manager, like the supervised filters.
 
         :param pid: The pid of the process.
         :return: True if the process is running, False otherwise.
@@ -49,5 +68,107 @@ class HeartBeat:
             kill(pid, 0)
         except OSError:
             return False
-        else:
+
+        try:
+            if psutil.Process(pid).status() != psutil.STATUS_ZOMBIE:
+                return True
+        except psutil.NoSuchProcess:
+            return False
+        except psutil.Error:
             return True
+        HeartBeat.reap(pid)
+        return False
+
+    @staticmethod
+    def open_pidfd(pid):
+        """
+        Get a file descriptor referring to the process, readable once the process exits (Linux only).
+
+        :param pid: The pid of the process.
+        :return: The pidfd on success, None if pidfds are not supported.
+        :raise ProcessLookupError: If the process does not exist.
+        """
+        if hasattr(os, 'pidfd_open'):
+            try:
+                return os.pidfd_open(pid)
+            except ProcessLookupError:
+                raise
+            except OSError:
+                return None
+
+        uname = os.uname()
+        if _syscall is None or uname.sysname != 'Linux' or uname.machine not in SYS_pidfd_open_MACHINES:
+            return None
+
+        fd = _syscall(SYS_pidfd_open, ctypes.c_int(pid), ctypes.c_uint(0))
+        if fd < 0:
+            errno = ctypes.get_errno()
+            if errno == 3:  # ESRCH
+                raise ProcessLookupError(errno, os.strerror(errno))
+            return None
+        return fd
+
+    @staticmethod
+    def reap(pid):
+        """
+        Collect the exit status of the process if it is a child of the current one.
+
+        :param pid: The pid of the process.
+        """
+        try:
+            os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            pass
+
+    @staticmethod
+    def wait_process_exit(pid, timeout):
+        """
+        Wait for the process to exit.
+        Uses a pidfd on Linux, a kqueue on BSD systems, and polling otherwise.
+
+        :param pid: The pid of the process.
+        :param timeout: The maximum time to wait, in seconds.
+        :return: True if the process exited before the timeout, False otherwise.
+        """
+        try:
+            pidfd = HeartBeat.open_pidfd(pid)
+        except ProcessLookupError:
+            return True
+
+        if pidfd is not None:
+            try:
+                # poll, unlike select, handles descriptors above FD_SETSIZE
+                poller = select.poll()
+                poller.register(pidfd, select.POLLIN)
+                readable = poller.poll(max(timeout, 0) * 1000)
+            finally:
+                os.close(pidfd)
+            if readable:
+                HeartBeat.reap(pid)
+                return True
+            return False
+
+        if hasattr(select, 'kqueue'):
+            kq = select.kqueue()
+            try:
+                event = select.kevent(pid, filter=select.KQ_FILTER_PROC,
+                                      flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                                      fflags=select.KQ_NOTE_EXIT)
+                if kq.control([event], 1, timeout):
+                    HeartBeat.reap(pid)
+                    return True
+                return False
+            except ProcessLookupError:
+                return True
+            finally:
+                kq.close()
+
+        deadline = time() + timeout
+        delay = 0.01
+        while HeartBeat.check_process(pid):
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.2)
+        return True
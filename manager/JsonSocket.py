@@ -7,21 +7,47 @@ __email__ = "contact@vultureproject.org"
 __doc__ = 'JSON encoding and decoding socket encapsulation class'
 
 import json
+import re
+from threading import Lock
 
 
 class JsonSocket:
     """
     Encapsulation of a socket made to send and receive JSON.
+
+    Two framings are supported:
+    - bare JSON, where each message is a JSON object sent as is;
+    - length-prefixed frames, where each message is preceded by a '#<length>\n' header,
+      length being the size of the JSON payload in bytes.
+    The framing of the peer is detected from the first message received,
+    and the messages sent afterwards use the same framing.
     """
 
-    def __init__(self, sock):
+    FRAME_MARKER = b'#'
+    # Longest frame header accepted: the marker, up to 20 digits and the newline
+    MAX_HEADER_SIZE = 22
+    MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+    RECV_SIZE = 65536
+    # Bytes ignored between messages
+    PADDING = b' \t\r\n\x00'
+    # Bytes changing the nesting of a bare JSON object, none of them can appear inside a UTF-8 multi-byte sequence
+    STRUCTURAL = re.compile(b'[\\\\"{}]')
+
+    def __init__(self, sock, framed=None):
         """
         Constructor. Set timeout to the socket.
 
         :param sock: The socket to encapsulate.
+        :param framed: Whether the messages sent are length-prefixed,
+                       None to use the framing of the first message received.
         """
         self._socket = sock
         self._socket.settimeout(1)
+        self._buffer = bytearray()
+        self._reset_scan()
+        self.framed = framed
+        # Replies to pipelined commands may be sent from several threads
+        self._send_lock = Lock()
 
     def __del__(self):
         """
@@ -35,8 +61,27 @@ class JsonSocket:
 
         :param data: The data to send.
         """
-        j = json.dumps(data)
-        self._socket.send(j.encode('ascii'))
+        payload = json.dumps(data).encode('ascii')
+        if self.framed:
+            payload = b''.join([self.FRAME_MARKER, str(len(payload)).encode('ascii'), b'\n', payload])
+        with self._send_lock:
+            self._socket.sendall(payload)
+
+    def send_line(self, data):
+        """
+        Send the given data as a line of JSON, framed instead if the peer uses frames.
+
+        :param data: The data to send.
+        """
+        if self.framed:
+            self.send(data)
+            return
+        payload = json.dumps(data).encode('ascii') + b'\n'
+        with self._send_lock:
+            self._socket.sendall(payload)
+
+    def fileno(self):
+        return self._socket.fileno()
 
     def recv(self):
         """
@@ -44,27 +89,145 @@ class JsonSocket:
 
         :return: Dict object containing the deserialized JSON data.
         """
-        data = ''
-        cpt = 0
-        first_chunk = True
         while True:
-            chunk = self._socket.recv(2048)
-            chunk = chunk.decode().rstrip('\x00')
-            if not chunk:
-                raise ValueError('No data received')
-            for c in chunk:
-                if first_chunk:
-                    if c != '{':
-                        raise TypeError('Data received not a json')
-                    cpt += 1
-                    first_chunk = False
-                else:
-                    if c == '{':
-                        cpt += 1
-                    elif c == '}':
-                        cpt -= 1
-            data += chunk
-
-            # Full JSON received ?
-            if cpt == 0:
-                return json.loads(data)
+            message = self._next_message()
+            if message is not None:
+                return message
+            self._fill()
+
+    def recv_available(self):
+        """
+        Receive the data available on the socket, without waiting for more.
+        To be called once the socket is readable.
+
+        :return: The list of the complete messages received, possibly empty.
+        """
+        self._fill()
+        return self.buffered()
+
+    def buffered(self):
+        """
+        :return: The list of the complete messages already received and not returned yet, possibly empty.
+        """
+        messages = []
+        while True:
+            message = self._next_message()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def _next_message(self):
+        """
+        Extract the next complete message from the buffer.
+
+        :return: The deserialized message, None if no complete message was received yet.
+        """
+        start = 0
+        while start < len(self._buffer) and self._buffer[start] in self.PADDING:
+            start += 1
+        del self._buffer[:start]
+        if not self._buffer:
+            return None
+
+        framed = self._buffer[:1] == self.FRAME_MARKER
+        if self.framed is None:
+            self.framed = framed
+
+        if framed:
+            return self._next_frame()
+        if self._buffer[:1] != b'{':
+            # Only objects can be delimited without framing
+            raise json.JSONDecodeError('Data received not a json object', self._buffer[:64].decode(errors='replace'), 0)
+        return self._next_bare()
+
+    def _fill(self):
+        """
+        Receive the next chunk of data into the buffer.
+
+        :return: The chunk received.
+        """
+        chunk = self._socket.recv(self.RECV_SIZE)
+        if not chunk:
+            raise ValueError('No data received')
+        self._buffer += chunk
+        if len(self._buffer) > self.MAX_MESSAGE_SIZE + self.MAX_HEADER_SIZE:
+            raise ValueError('Message too large')
+        return chunk
+
+    def _next_frame(self):
+        end = self._buffer.find(b'\n', 0, self.MAX_HEADER_SIZE)
+        if end == -1:
+            if len(self._buffer) >= self.MAX_HEADER_SIZE:
+                raise ValueError('Invalid frame header')
+            return None
+
+        try:
+            length = int(self._buffer[1:end])
+        except ValueError:
+            raise ValueError('Invalid frame header')
+        if length < 0 or length > self.MAX_MESSAGE_SIZE:
+            raise ValueError('Invalid frame length: {}'.format(length))
+
+        size = end + 1 + length
+        if len(self._buffer) < size:
+            return None
+        payload = bytes(self._buffer[end + 1:size])
+        del self._buffer[:size]
+        return json.loads(payload.decode())
+
+    def _reset_scan(self):
+        # State of the scan of the bare JSON object at the start of the buffer
+        self._scan_pos = 0
+        self._scan_depth = 0
+        self._scan_in_string = False
+        self._scan_escape = False
+
+    def _next_bare(self):
+        end = self._scan_bare()
+        if end is None:
+            return None
+        payload = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        self._reset_scan()
+        return json.loads(payload.decode())
+
+    def _scan_bare(self):
+        """
+        Scan the bytes received since the previous call for the end of the JSON object at the start of the buffer,
+        tracking the nesting depth and the strings, so that each byte is scanned once.
+
+        :return: The size in bytes of the object, None if it is not complete yet.
+        """
+        buffer = self._buffer
+        pos = self._scan_pos
+        if self._scan_escape:
+            if pos >= len(buffer):
+                return None
+            # The escaped character
+            pos += 1
+            self._scan_escape = False
+
+        while True:
+            match = self.STRUCTURAL.search(buffer, pos)
+            if match is None:
+                self._scan_pos = len(buffer)
+                return None
+            char = buffer[match.start()]
+            pos = match.end()
+            if self._scan_in_string:
+                if char == ord('\\'):
+                    if pos >= len(buffer):
+                        self._scan_pos = pos
+                        self._scan_escape = True
+                        return None
+                    pos += 1
+                elif char == ord('"'):
+                    self._scan_in_string = False
+            elif char == ord('"'):
+                self._scan_in_string = True
+            elif char == ord('{'):
+                self._scan_depth += 1
+            elif char == ord('}'):
+                self._scan_depth -= 1
+                if self._scan_depth == 0:
+                    return pos
@@ -0,0 +1,91 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Percentiles of the latency histograms of the filters'
+
+
+class LatencyHistogram:
+    """
+    Handle the latency histograms sent by the filters in their monitoring data, as
+    {"count": <count>, "sum_us": <sum of the durations>, "buckets": [<count of each bucket>]}.
+    Bucket 0 counts the durations under 1 microsecond, and bucket i the durations
+    in [2^(i-1), 2^i[ microseconds, the last one being unbounded.
+    The histograms count the requests since the start of the filter.
+    """
+
+    # Number of buckets of the histograms, the last one being unbounded
+    BUCKETS = 32
+    PERCENTILES = [('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)]
+
+    @staticmethod
+    def _bounds(bucket):
+        """
+        :return: The lower and upper bounds of a bucket, in microseconds.
+        """
+        if bucket == 0:
+            return 0, 1
+        if bucket >= LatencyHistogram.BUCKETS - 1:
+            return 2 ** (bucket - 1), 2 ** (bucket - 1)
+        return 2 ** (bucket - 1), 2 ** bucket
+
+    @staticmethod
+    def merge(histograms):
+        """
+        Merge the histograms of the instances of a filter.
+
+        :param histograms: A list of dicts of histograms by stage.
+        :return: The dict of the merged histograms by stage.
+        """
+        merged = {}
+        for stages in histograms:
+            for stage, histogram in stages.items():
+                total = merged.setdefault(stage, {'count': 0, 'sum_us': 0, 'buckets': []})
+                total['count'] += histogram.get('count', 0)
+                total['sum_us'] += histogram.get('sum_us', 0)
+                buckets = histogram.get('buckets', [])
+                total['buckets'].extend([0] * (len(buckets) - len(total['buckets'])))
+                for i, count in enumerate(buckets):
+                    total['buckets'][i] += count
+        return merged
+
+    @staticmethod
+    def percentile(histogram, quantile):
+        """
+        Estimate a percentile of a histogram, interpolating linearly inside the bucket holding it.
+
+        :param histogram: The histogram.
+        :param quantile: The quantile, between 0 and 1.
+        :return: The percentile in milliseconds, None if the histogram is empty.
+        """
+        buckets = histogram.get('buckets', [])
+        total = sum(buckets)
+        if not total:
+            return None
+
+        rank = quantile * total
+        seen = 0
+        for bucket, count in enumerate(buckets):
+            if count and seen + count >= rank:
+                lower, upper = LatencyHistogram._bounds(bucket)
+                return (lower + (upper - lower) * (rank - seen) / count) / 1000
+            seen += count
+        return LatencyHistogram._bounds(len(buckets) - 1)[1] / 1000
+
+    @staticmethod
+    def summary(histograms):
+        """
+        Summarize the histograms of a filter.
+
+        :param histograms: The dict of the histograms by stage ('parse', 'processing', 'response_write').
+        :return: A dict of the count, the average and the percentiles of each stage, in milliseconds.
+        """
+        summary = {}
+        for stage, histogram in histograms.items():
+            count = histogram.get('count', 0)
+            summary[stage] = {'count': count, 'avg_ms': histogram.get('sum_us', 0) / count / 1000 if count else None}
+            for name, quantile in LatencyHistogram.PERCENTILES:
+                summary[stage][name] = LatencyHistogram.percentile(histogram, quantile)
+        return summary
@@ -0,0 +1,219 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'OpenMetrics exposition of the filters stats'
+
+import logging
+import os
+import socket
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+from time import monotonic
+
+logger = logging.getLogger()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        try:
+            body = self.server.metrics.render()
+        except Exception as e:
+            logger.error("MetricsServer: cannot render metrics: {}".format(e))
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', MetricsServer.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug("MetricsServer: {} - {}".format(self.address_string(), format % args))
+
+
+class _TCPMetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixMetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class MetricsServer:
+    """
+    Serve the filters stats in the OpenMetrics text format on '/metrics',
+    over HTTP on a local TCP port or on a Unix socket.
+
+    The exposition is rendered from the monitoring snapshot cache,
+    and kept for 'max_age_ms' so that the scrape cost does not depend on the number of filters.
+    """
+
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+    PREFIX = 'darwin_filter_'
+
+    # Filter counters: (monitoring key, metric name, type, help)
+    COUNTERS = [
+        ('received', 'received', 'counter', 'Entries received by the filter.'),
+        ('entryErrors', 'entry_errors', 'counter', 'Entries the filter could not process.'),
+        ('matches', 'matches', 'counter', 'Entries matched by the filter.'),
+        ('connections', 'connections', 'gauge', 'Connections currently open on the filter.'),
+        ('failures', 'failures', 'counter', 'Failures of the filter detected by the manager.')
+    ]
+
+    def __init__(self, services, conf):
+        """
+        Constructor.
+
+        :param services: The services manager.
+        :param conf: The 'metrics' configuration, with either 'unix_path', or 'port' and optionally 'ip'.
+        """
+        self._services = services
+        self._conf = dict(conf)
+        self._max_age = self._conf.get('max_age_ms', 1000) / 1000
+        self._lock = Lock()
+        self._rendered = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def conf(self):
+        return self._conf
+
+    def start(self):
+        """
+        Bind the endpoint and serve the scrapes in a thread.
+        """
+        unix_path = self._conf.get('unix_path')
+        if unix_path:
+            if os.path.lexists(unix_path):
+                os.remove(unix_path)
+            self._server = _UnixMetricsServer(unix_path, _MetricsHandler)
+        else:
+            self._server = _TCPMetricsServer((self._conf.get('ip', '127.0.0.1'), self._conf['port']), _MetricsHandler)
+        self._server.metrics = self
+
+        self._thread = Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True)
+        self._thread.start()
+        logger.info("MetricsServer: serving metrics on {}".format(
+            unix_path or '{}:{}'.format(self._conf.get('ip', '127.0.0.1'), self._conf['port'])))
+
+    def stop(self):
+        """
+        Stop serving and release the endpoint.
+        """
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._conf.get('unix_path'):
+            try:
+                os.remove(self._conf['unix_path'])
+            except FileNotFoundError:
+                pass
+
+    def render(self):
+        """
+        :return: The OpenMetrics exposition of the filters stats, as bytes.
+        """
+        with self._lock:
+            if self._rendered and monotonic() - self._rendered[0] <= self._max_age:
+                return self._rendered[1]
+            begin = monotonic()
+            body = MetricsServer.format(self._services.monitor_all(max_age_ms=self._max_age * 1000)).encode()
+            self._rendered = (begin, body)
+            return body
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _labels(labels):
+        return ','.join('{}="{}"'.format(k, MetricsServer._escape(v)) for k, v in labels)
+
+    @staticmethod
+    def _number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    @staticmethod
+    def _filters(monitor_data):
+        """
+        Flatten the monitoring data, reporting the instances of multi-instance filters with an 'instance' label.
+
+        :return: A list of (labels, data) tuples.
+        """
+        filters = []
+        for name, data in sorted(monitor_data.items()):
+            instances = data.get('instances')
+            if instances:
+                for instance, instance_data in sorted(instances.items()):
+                    filters.append(([('filter', name), ('instance', instance)], instance_data))
+            else:
+                filters.append(([('filter', name)], data))
+        return filters
+
+    @staticmethod
+    def format(monitor_data):
+        """
+        Format monitoring data in the OpenMetrics text format.
+
+        :param monitor_data: The monitoring data of the filters, as returned by Services.monitor_all.
+        :return: The exposition, as a str.
+        """
+        filters = MetricsServer._filters(monitor_data)
+        lines = []
+
+        name = MetricsServer.PREFIX + 'up'
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('# HELP {} Whether the filter is running.'.format(name))
+        for labels, data in filters:
+            lines.append('{}{{{}}} {}'.format(name, MetricsServer._labels(labels),
+                                              1 if data.get('status') == 'running' else 0))
+
+        for key, metric, metric_type, description in MetricsServer.COUNTERS:
+            name = MetricsServer.PREFIX + metric
+            sample = name + '_total' if metric_type == 'counter' else name
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            lines.append('# HELP {} {}'.format(name, description))
+            for labels, data in filters:
+                if MetricsServer._number(data.get(key)):
+                    lines.append('{}{{{}}} {}'.format(sample, MetricsServer._labels(labels), data[key]))
+
+        # Process stats, the structured ones (memory_info, cpu_times...) having a sample per field
+        samples = {}
+        for labels, data in filters:
+            for stat, value in sorted(data.get('proc_stats', {}).items()):
+                name = MetricsServer.PREFIX + 'proc_' + stat
+                if MetricsServer._number(value):
+                    samples.setdefault(name, []).append((labels, value))
+                elif hasattr(value, '_asdict'):
+                    for field, field_value in value._asdict().items():
+                        if MetricsServer._number(field_value):
+                            samples.setdefault(name, []).append((labels + [('field', field)], field_value))
+        for name, values in sorted(samples.items()):
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in values:
+                lines.append('{}{{{}}} {}'.format(name, MetricsServer._labels(labels), value))
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
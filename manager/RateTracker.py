@@ -0,0 +1,144 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Rates and ratios of the filters monitoring counters'
+
+from math import exp
+from threading import Lock
+
+
+class RateTracker:
+    """
+    Derive rates from the cumulative counters of the filters monitoring data.
+
+    The previous sample of each filter is kept, and each new sample gives the per second rates
+    of its counters since the previous one, along with their 1, 5 and 15 minutes exponentially
+    weighted moving averages. A counter lower than in the previous sample, or a filter process
+    reported as restarted, means the counters started over from zero.
+    """
+
+    # Monitoring counter -> rate name
+    RATES = [('received', 'events'), ('entryErrors', 'errors'), ('matches', 'matches')]
+    # Moving averages windows, in seconds
+    WINDOWS = [('1m', 60), ('5m', 300), ('15m', 900)]
+    # Samples closer than this to the previous one give the previous rates, in seconds
+    MIN_INTERVAL = 1
+
+    def __init__(self):
+        self._lock = Lock()
+        # name -> (sample time, counters, rates)
+        self._samples = {}
+        # Names of the filters whose counters started over since their last sample
+        self._restarted = set()
+
+    def restarted(self, name):
+        """
+        Note that the process of a filter was replaced, its counters starting over from zero.
+
+        :param name: The name of the filter.
+        """
+        with self._lock:
+            if name in self._samples:
+                self._restarted.add(name)
+
+    def prune(self, names):
+        """
+        Forget the filters not in names.
+
+        :param names: The names of the existing filters.
+        """
+        with self._lock:
+            for name in [n for n in self._samples if n not in names]:
+                del self._samples[name]
+                self._restarted.discard(name)
+
+    @staticmethod
+    def _empty():
+        rates = {}
+        for _, rate in RateTracker.RATES:
+            rates[rate + '_per_s'] = None
+            for window, _ in RateTracker.WINDOWS:
+                rates['{}_per_s_{}'.format(rate, window)] = None
+        return RateTracker._ratios(rates)
+
+    @staticmethod
+    def _ratio(part, total):
+        if part is None or not total:
+            return None
+        return part / total
+
+    @staticmethod
+    def _ratios(rates):
+        rates['match_ratio'] = RateTracker._ratio(rates['matches_per_s'], rates['events_per_s'])
+        for window, _ in RateTracker.WINDOWS:
+            rates['match_ratio_' + window] = RateTracker._ratio(rates['matches_per_s_' + window],
+                                                                rates['events_per_s_' + window])
+        return rates
+
+    def update(self, name, data, now):
+        """
+        Add a sample of the counters of a filter.
+
+        :param name: The name of the filter.
+        :param data: The monitoring data of the filter.
+        :param now: The monotonic time of the sample.
+        :return: A dict of the rates of the filter, with None values until two samples were taken.
+        """
+        counters = {c: data.get(c) for c, _ in RateTracker.RATES}
+        if any(not isinstance(v, int) for v in counters.values()):
+            return RateTracker._empty()
+
+        with self._lock:
+            previous = self._samples.get(name)
+            if previous is None:
+                rates = RateTracker._empty()
+                self._samples[name] = (now, counters, rates)
+                return dict(rates)
+
+            last_time, last_counters, last_rates = previous
+            elapsed = now - last_time
+            if elapsed < RateTracker.MIN_INTERVAL:
+                return dict(last_rates)
+
+            restarted = name in self._restarted
+            self._restarted.discard(name)
+            rates = {}
+            for counter, rate in RateTracker.RATES:
+                value = counters[counter]
+                if restarted or value < last_counters[counter]:
+                    # The counter started over from zero after the previous sample
+                    delta = value
+                else:
+                    delta = value - last_counters[counter]
+                current = delta / elapsed
+                rates[rate + '_per_s'] = current
+                for window, seconds in RateTracker.WINDOWS:
+                    key = '{}_per_s_{}'.format(rate, window)
+                    average = last_rates[key]
+                    if average is None:
+                        rates[key] = current
+                    else:
+                        alpha = 1 - exp(-elapsed / seconds)
+                        rates[key] = average + alpha * (current - average)
+            rates = RateTracker._ratios(rates)
+            self._samples[name] = (now, counters, rates)
+            return dict(rates)
+
+    @staticmethod
+    def combine(rates_list):
+        """
+        Sum the rates of the instances of a filter.
+
+        :param rates_list: The rates of each instance.
+        :return: The rates of the filter, None values being ignored.
+        """
+        combined = RateTracker._empty()
+        for rates in rates_list:
+            for key, value in rates.items():
+                if key.startswith('match_ratio') or value is None:
+                    continue
+                combined[key] = (combined[key] or 0) + value
+        return RateTracker._ratios(combined)
@@ -9,17 +9,28 @@ __doc__ = 'Services / filters management'
 import logging
 import json
 import socket
-from threading import Lock
+import selectors
+from threading import Lock, Thread
 from copy import deepcopy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from subprocess import Popen, call, TimeoutExpired
 from os import kill, remove, access, F_OK
+from os.path import dirname
 from signal import SIGTERM, SIGUSR1, SIGKILL
 from pprint import pprint
-from JsonSocket import JsonSocket
 from HeartBeat import HeartBeat
-from time import sleep
+from Watcher import DirectoryWatcher
+from Supervisor import Supervisor
+from Balancer import Balancer
+from Cgroup import Cgroup
+from StartupTrace import StartupTrace
+from SnapshotCache import SnapshotCache
+from RateTracker import RateTracker
+from LatencyHistogram import LatencyHistogram
+from time import sleep, time, monotonic
 import psutil
-from config import load_conf, ConfParseError
+from config import load_conf, ConfParseError, manager_settings
 
 logger = logging.getLogger()
 
@@ -29,55 +40,505 @@ class Services:
     Manage services execution, monitoring and configuration.
     """
 
+    # Cumulative counters of the filters monitoring data
+    MONITORING_COUNTERS = ['connections', 'received', 'entryErrors', 'matches']
+    # Fields of the monitoring data provided by the monitoring socket of the filters
+    MONITORING_SOCKET_FIELDS = ['status', 'rates', 'latency'] + MONITORING_COUNTERS
+
+    # Per filter scheduling settings, applied to the filter processes
+    SCHEDULING_SETTINGS = ['cpu_affinity', 'nice', 'ionice']
+    IONICE_CLASSES = {
+        'none': 'IOPRIO_CLASS_NONE',
+        'realtime': 'IOPRIO_CLASS_RT',
+        'best_effort': 'IOPRIO_CLASS_BE',
+        'idle': 'IOPRIO_CLASS_IDLE'
+    }
+
+    # Bounds of the delay between two readiness probes of a starting filter, in seconds
+    READY_PROBE_MIN_DELAY = 0.005
+    READY_PROBE_MAX_DELAY = 0.1
+    # Bounds of the delay between two connections counts of a draining filter, in seconds
+    DRAIN_PROBE_MIN_DELAY = 0.01
+    DRAIN_PROBE_MAX_DELAY = 0.25
+
     def __init__(self, filters):
         """
         Constructor, load configuration pointed by config_file.
 
         :param config_file: Path to the filters configuration file.
         """
+        # The filters table is copy-on-write: it is never modified in place,
+        # so it can be iterated without locking
         self._filters = deepcopy(filters)
+        # Serializes configuration updates
         self._lock = Lock()
+        # Protects the replacement of the filters table and the creation of the filter locks
+        self._table_lock = Lock()
+        # Serialize the lifecycle operations of each filter
+        self._filter_locks = {}
+        # Ready standby instances of the filters, by filter name
+        self._standbys = {}
+        # Load balancers of the multi-instance filters, by filter name
+        self._balancers = {}
+        # Last startup traces of the filters, by filter name
+        self._startup_traces = {}
+        # Process handles of the filters, by filter name
+        self._processes = {}
+        # Last monitoring data collected, by process stats requested
+        self._monitoring_cache = SnapshotCache(self._collect_monitoring)
+        # Previous counters of the filters, to derive their rates
+        self._rates = RateTracker()
+        self._supervisor = None
+
+        if manager_settings.get('supervise', False):
+            supervisor = Supervisor(self._on_filter_exit)
+            if supervisor.available:
+                self._supervisor = supervisor
+            else:
+                logger.warning("Filters supervision not available, falling back to heartbeat")
+
+        if manager_settings.get('cgroup_root') and not Cgroup.setup_root(manager_settings['cgroup_root']):
+            logger.warning("Filters cgroup isolation not available")
+
+    def _filter_lock(self, name):
+        """
+        Get the lock serializing the lifecycle operations of a filter.
+
+        :param name: The name of the filter.
+        :return: The Lock object of the filter.
+        """
+        with self._table_lock:
+            return self._filter_locks.setdefault(name, Lock())
+
+    def _replace_filter(self, name, filter):
+        """
+        Replace (or add) a filter in the filters table, without modifying the current table.
+
+        :param name: The name of the filter.
+        :param filter: The new dict of the filter, None to remove the filter from the table.
+        """
+        with self._table_lock:
+            filters = dict(self._filters)
+            if filter is None:
+                filters.pop(name, None)
+            else:
+                filters[name] = filter
+            self._filters = filters
+
+    def _new_trace(self, filter, operation):
+        """
+        Start timing the startup phases of a filter, keeping the last 'startup_traces' traces of each filter.
+
+        :param filter: The dict of the starting filter.
+        :param operation: The operation starting the filter.
+        :return: The StartupTrace object.
+        """
+        trace = StartupTrace(filter['name'], operation)
+        with self._table_lock:
+            traces = self._startup_traces.get(filter['name'])
+            maxlen = manager_settings.get('startup_traces', 10)
+            if traces is None or traces.maxlen != maxlen:
+                traces = deque(traces or [], maxlen=maxlen)
+                self._startup_traces[filter['name']] = traces
+            traces.append(trace)
+        return trace
+
+    def startup_traces(self, names=None):
+        """
+        Get the last startup traces of the filters.
+
+        :param names: The names of the filters to get the traces of, all the filters if empty.
+        :return: A dict associating the filters names to the list of their traces, oldest first.
+        """
+        with self._table_lock:
+            traces = {n: list(t) for n, t in self._startup_traces.items()}
+        return {n: [trace.to_dict() for trace in t] for n, t in traces.items() if not names or n in names}
+
+    @property
+    def supervisor(self):
+        """
+        The supervisor tracking the filter processes, None if supervision is disabled.
+        """
+        return self._supervisor
+
+    def _supervise(self, filter):
+        """
+        Start tracking the process of the filter, if supervision is enabled.
+
+        :param filter: The dict of the filter to track.
+        """
+        if not self._supervisor:
+            return
+        pid = HeartBeat.check_pid_file(filter['pid_file'])
+        if pid:
+            self._supervisor.watch(filter['name'], pid)
+        else:
+            logger.warning("Cannot supervise filter {}: PID not accessible".format(filter['name']))
+
+    def _on_filter_exit(self, name, pid):
+        """
+        Called by the supervisor when a supervised filter process exits.
+
+        :param name: The name of the filter.
+        :param pid: The pid of the exited process.
+        """
+        filter = self._filters.get(name)
+        if filter:
+            Thread(target=self._restart_failed,
+                   args=(filter, "process {} exited".format(pid)),
+                   daemon=True).start()
+
+    def _restart_failed(self, filter, reason):
+        """
+        Restart a failed filter, unless it was stopped or replaced in the meantime.
+        Meant to be run in its own thread, so that monitoring the other filters is not delayed.
+
+        :param filter: The dict of the failed filter.
+        :param reason: The reason of the failure.
+        """
+        with self._filter_lock(filter['name']):
+            if self._filters.get(filter['name']) is not filter or \
+                    filter['status'] in [psutil.STATUS_STOPPED, psutil.STATUS_TRACING_STOP]:
+                return
+            if filter['status'] != psutil.STATUS_DEAD:
+                logger.warning("Filter {} failed ({}). Restarting the filter.".format(filter['name'], reason))
+                filter['failures'] += 1
+                filter['status'] = psutil.STATUS_DEAD
+            if not self._failover(filter):
+                self.restart_one(filter, no_lock=True)
+        self._spawn_standby_async(filter['name'])
+
+    @staticmethod
+    def _alternate_extension(extension):
+        """
+        Get the extension used by the other instance of a filter for blue/green swaps.
+        """
+        return '.1' if extension == '.2' else '.2'
+
+    @staticmethod
+    def _instance(filter, extension):
+        """
+        Build the dict of another instance of the filter, with its own pid file and sockets.
+
+        :param filter: The dict of the filter.
+        :param extension: The extension of the instance files.
+        :return: The dict of the new instance.
+        """
+        instance = deepcopy(filter)
+        instance['extension'] = extension
+        instance['pid_file'] = '{}/{}{}.pid'.format(dirname(filter['pid_file']), filter['name'], extension)
+        instance['socket'] = '{}/{}{}.sock'.format(dirname(filter['socket']), filter['name'], extension)
+        instance['monitoring'] = '{}/{}_mon{}.sock'.format(dirname(filter['monitoring']), filter['name'], extension)
+        return instance
+
+    @staticmethod
+    def _apply_scheduling(filter):
+        """
+        Apply the 'cpu_affinity', 'nice' and 'ionice' settings of the filter to its daemonized process.
+        On Linux, these attributes are set per thread, so they are applied to every thread of the process.
+
+        :param filter: The dict of the filter.
+        """
+        settings = [k for k in Services.SCHEDULING_SETTINGS if k in filter]
+        if not settings:
+            return
+
+        pid = HeartBeat.check_pid_file(filter['pid_file'])
+        if not pid:
+            logger.error("Cannot apply scheduling settings to filter {}: PID not accessible".format(filter['name']))
+            return
+
+        try:
+            proc = psutil.Process(pid)
+            targets = [psutil.Process(t.id) for t in proc.threads()] if psutil.LINUX else [proc]
+            for target in targets:
+                if 'cpu_affinity' in settings:
+                    target.cpu_affinity(filter['cpu_affinity'])
+                if 'nice' in settings:
+                    target.nice(filter['nice'])
+                if 'ionice' in settings:
+                    ioclass = getattr(psutil, Services.IONICE_CLASSES[filter['ionice']['class']])
+                    target.ionice(ioclass, filter['ionice'].get('value'))
+        except (psutil.Error, AttributeError, ValueError, OSError) as e:
+            logger.error("Cannot apply scheduling settings to filter {}: {}".format(filter['name'], e))
+            return
+
+        logger.debug("Applied scheduling settings {} to filter {}".format(settings, filter['name']))
+
+    @staticmethod
+    def _attach_cgroup(filter, pid):
+        """
+        Move the process of the filter into its own cgroup, with its 'cpu_max', 'memory_high'
+        and 'memory_max' limits, if a 'cgroup_root' is configured for the manager.
+
+        :param filter: The dict of the filter.
+        :param pid: The pid of the filter process.
+        """
+        root = manager_settings.get('cgroup_root')
+        if root:
+            Cgroup.attach(root, filter, pid)
+
+    def _spawn_standby_async(self, name):
+        """
+        Spawn the standby instance of a filter in the background.
+
+        :param name: The name of the filter.
+        """
+        Thread(target=self._spawn_standby, args=(name,), daemon=True).start()
+
+    def _spawn_standby(self, name):
+        """
+        Spawn the standby instance of a running filter on the alternate extension,
+        if the filter is configured with 'standby' and has no ready standby yet.
+
+        :param name: The name of the filter.
+        """
+        with self._filter_lock(name):
+            filter = self._filters.get(name)
+            if not filter or not filter.get('standby') or name in self._standbys or \
+                    filter['status'] != psutil.STATUS_RUNNING:
+                return
+
+            spare = Services._instance(filter, Services._alternate_extension(filter['extension']))
+            self.clean_one(spare, no_lock=True)
+            trace = self._new_trace(spare, 'standby')
+            if self.start_one(spare, no_lock=True, trace=trace):
+                ret = Services._wait_process_ready(spare, trace=trace)
+                trace.finish(ret)
+                if not ret:
+                    Services._apply_scheduling(spare)
+                    spare['status'] = psutil.STATUS_RUNNING
+                    self._standbys[name] = spare
+                    logger.info("Standby instance of filter {} ready".format(name))
+                    return
+                logger.error("Error when starting standby instance of filter {}: {}".format(name, ret))
+
+            self.stop(name, spare['pid_file'], pid=spare.get('pid'))
+            self.clean_one(spare, no_lock=True)
+
+    def _stop_standby(self, name):
+        """
+        Stop the standby instance of a filter, if any.
+        The caller must hold the filter lock.
+
+        :param name: The name of the filter.
+        """
+        spare = self._standbys.pop(name, None)
+        if spare:
+            self.stop(name, spare['pid_file'], pid=spare.get('pid'))
+            self.clean_one(spare, no_lock=True)
+
+    def _standby_running(self, name):
+        """
+        Check that the standby instance of a filter is still running.
+
+        :param name: The name of the filter.
+        :return: True if the filter has a ready standby instance whose process is running, False otherwise.
+        """
+        spare = self._standbys.get(name)
+        if not spare:
+            return False
+        pid = HeartBeat.check_pid_file(spare['pid_file']) or spare.get('pid')
+        return bool(pid) and HeartBeat.check_process(pid)
+
+    def _failover(self, filter):
+        """
+        Replace a failed filter by its standby instance, by switching the socket symlink.
+        The caller must hold the filter lock.
+
+        :param filter: The dict of the failed filter.
+        :return: True if the standby instance took over, False otherwise.
+        """
+        name = filter['name']
+        spare = self._standbys.pop(name, None)
+        if not spare:
+            return False
+
+        pid = HeartBeat.check_pid_file(spare['pid_file'])
+        if not pid or not HeartBeat.check_process(pid) or not HeartBeat.check_socket(spare['socket']):
+            logger.warning("Standby instance of filter {} is not running, cannot failover".format(name))
+            self.stop(name, spare['pid_file'], pid=spare.get('pid'))
+            self.clean_one(spare, no_lock=True)
+            return False
+
+        if call(['ln', '-sfn', spare['socket'], filter['socket_link']]) != 0:
+            logger.error("Unable to link standby instance of filter {}".format(name))
+            self._standbys[name] = spare
+            return False
+
+        spare['failures'] = filter['failures']
+        # Supervising the standby instance stops supervising the failed one
+        self._supervise(spare)
+        self.stop(name, filter['pid_file'], pid=filter.get('pid'))
+        self.clean_one(filter, no_lock=True)
+        self._forget_process(name)
+        self._rates.restarted(name)
+        self._replace_filter(name, spare)
+        logger.warning("Filter {} failed over to its standby instance".format(name))
+        return True
 
     def start_all(self):
         """
         Start all the filters.
+        If parallel startup is enabled in the manager configuration, independent
+        filters are started concurrently, each filter being started only once
+        the filter it forwards to (its 'next_filter') has been started.
+
+        :return: A dict containing the total and per-filter boot times, in seconds.
         """
-        for _, filter in self._filters.items():
-            if self.start_one(filter, True):
-                ret = Services._wait_process_ready(filter)
-                if ret:
-                    logger.error("Error when starting filter {}: {}".format(filter['name'], ret))
-                    self.stop_one(filter, no_lock=True)
-                    self.clean_one(filter, no_lock=True)
-                else:
-                    logger.debug("Linking UNIX sockets...")
-                    filter['status'] = psutil.STATUS_RUNNING
-                    call(['ln', '-s', filter['socket'], filter['socket_link']])
+        boot_times = {}
+        begin = time()
+
+        if manager_settings.get('parallel_start', False):
+            dependencies = self._start_dependencies()
+            started = set()
+            pending = {}
+            with ThreadPoolExecutor(max_workers=manager_settings.get('start_workers', 4)) as executor:
+                while dependencies or pending:
+                    ready = [n for n, d in dependencies.items() if d <= started]
+                    if not ready and not pending:
+                        logger.warning("Circular 'next_filter' dependency between filters {}, "
+                                       "starting them anyway".format(list(dependencies.keys())))
+                        ready = list(dependencies.keys())
+
+                    for n in ready:
+                        dependencies.pop(n)
+                        pending[executor.submit(self._start_and_link, self._filters[n])] = n
+
+                    done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        n = pending.pop(future)
+                        boot_times[n] = future.result()
+                        started.add(n)
+        else:
+            for n, filter in self._filters.items():
+                boot_times[n] = self._start_and_link(filter)
 
-    def rotate_logs_all(self):
+        total = time() - begin
+        for n, t in boot_times.items():
+            logger.info("Filter {} booted in {:.3f}s".format(n, t))
+        logger.info("All filters booted in {:.3f}s".format(total))
+
+        return {'total': total, 'filters': boot_times}
+
+    def _start_dependencies(self):
         """
-        Reset the logs of all the filters
+        Build the startup dependency graph of the filters, based on their 'next_filter'.
+
+        :return: A dict associating each filter name to the set of filter names
+                 that must be started before it.
         """
-        with self._lock:
-            for _, filter in self._filters.items():
-                try:
-                    self.rotate_logs_one(filter, True)
-                except Exception:
-                    pass
+        dependencies = {}
+        for n, filter in self._filters.items():
+            next_filter = filter.get('next_filter')
+            dependencies[n] = {m for m, f in self._filters.items()
+                               if m != n and (m == next_filter or f.get('instance_of') == next_filter)}
+        return dependencies
+
+    def _start_and_link(self, filter):
+        """
+        Start the filter, wait for it to be ready and link its socket.
 
-    def stop_all(self):
+        :param filter: The dict of the filter to start.
+        :return: The time spent starting the filter, in seconds.
+        """
+        begin = time()
+        trace = self._new_trace(filter, 'start')
+        if self.start_one(filter, True, trace=trace):
+            ret = Services._wait_process_ready(filter, trace=trace)
+            trace.finish(ret)
+            if ret:
+                logger.error("Error when starting filter {}: {}".format(filter['name'], ret))
+                self.stop_one(filter, no_lock=True)
+                self.clean_one(filter, no_lock=True)
+            else:
+                Services._apply_scheduling(filter)
+                logger.debug("Linking UNIX sockets...")
+                filter['status'] = psutil.STATUS_RUNNING
+                call(['ln', '-s', filter['socket'], filter['socket_link']])
+                self._supervise(filter)
+                self._ensure_balancer(filter)
+                self._spawn_standby_async(filter['name'])
+        return time() - begin
+
+    def _instances_sockets(self, name):
+        """
+        Get the sockets of the running instances of a multi-instance filter.
+
+        :param name: The name of the multi-instance filter.
+        :return: The list of the socket links of the running instances.
         """
-        Stop all the filters
+        return [f['socket_link'] for _, f in sorted(self._filters.items())
+                if f.get('instance_of') == name and f['status'] == psutil.STATUS_RUNNING]
+
+    def _ensure_balancer(self, filter):
+        """
+        Start the load balancer of the multi-instance filter the passed instance belongs to, if not running yet.
+
+        :param filter: The dict of the filter instance.
+        """
+        name = filter.get('instance_of')
+        if not name:
+            return
+        with self._table_lock:
+            if name in self._balancers:
+                return
+            balancer = Balancer(name, filter['balancer_socket'],
+                                lambda: self._instances_sockets(name),
+                                filter.get('balancing', 'round_robin'))
+            try:
+                balancer.start()
+            except OSError as e:
+                logger.error("Cannot start load balancer of filter {}: {}".format(name, e))
+                return
+            self._balancers[name] = balancer
+
+    def _release_balancers(self, all=False):
+        """
+        Stop the load balancers of the multi-instance filters having no instance left.
+
+        :param all: If set to True, stop all the load balancers.
+        """
+        with self._table_lock:
+            names = {f.get('instance_of') for f in self._filters.values()}
+            for name in list(self._balancers.keys()):
+                if all or name not in names:
+                    self._balancers.pop(name).stop()
+
+    def rotate_logs_all(self):
+        """
+        Reset the logs of all the filters
         """
         for _, filter in self._filters.items():
             try:
-                self.stop_one(filter, True)
-                logger.debug("stop_all: after stop_one")
-                self.clean_one(filter, True)
-                logger.debug("stop_all: after clean_one")
+                self.rotate_logs_one(filter)
             except Exception:
                 pass
 
+    def stop_all(self):
+        """
+        Stop all the filters concurrently.
+        """
+        def stop_and_clean(filter):
+            # Holding the filter lock waits for a standby instance being spawned,
+            # so that it is registered before the filter is stopped, and stopped with it
+            with self._filter_lock(filter['name']):
+                try:
+                    self.stop_one(filter, True)
+                    logger.debug("stop_all: after stop_one")
+                    self.clean_one(filter, True)
+                    logger.debug("stop_all: after clean_one")
+                except Exception:
+                    pass
+
+        if not self._filters:
+            return
+
+        with ThreadPoolExecutor(max_workers=len(self._filters)) as executor:
+            executor.map(stop_and_clean, list(self._filters.values()))
+
+        self._release_balancers(all=True)
+
     @staticmethod
     def _build_cmd(filt):
         """
@@ -132,11 +593,10 @@ class Services:
         Send SIGTERM signal to a program having his PID in file.
 
         :param file: The file containing the PID a a program.
+        :return: The PID the signal was sent to.
+        :raise FileNotFoundError: If the PID file does not exist.
         """
         logger.debug("Entering kill_with_pid_file")
-        if not access(file, F_OK):
-            logger.warning("Trying to read non-existing PID file...")
-            return
         with open(file, 'r') as f:
             pid = f.readline()
         logger.debug("Pid read : {}".format(pid))
@@ -144,21 +604,23 @@ class Services:
         logger.debug("SIGTERM sent")
         return int(pid)
 
-    def start_one(self, filter, no_lock=False):
+    def start_one(self, filter, no_lock=False, trace=None):
         """
         Start the filter.
 
         :param filter: The dict of the filter to start.
         :param no_lock: If set to True, will not lock mutex
+        :param trace: If a StartupTrace is given, the 'spawn' and 'daemonized' phases are recorded in it,
+                      and it is finished on error.
         """
 
         if not no_lock:
-            self._lock.acquire()
+            self._filter_lock(filter['name']).acquire()
 
         cmd = self._build_cmd(filter)
 
         if not no_lock:
-            self._lock.release()
+            self._filter_lock(filter['name']).release()
 
         # start process
         logger.debug("Starting {}".format(" ".join(cmd)))
@@ -169,7 +631,11 @@ class Services:
         except OSError as e:
             logger.error("cannot start filter: " + str(e))
             filter['status'] = psutil.STATUS_DEAD
+            if trace:
+                trace.finish("cannot start filter: {}".format(e))
             return False
+        if trace:
+            trace.mark('spawn')
         try:
             p.wait(timeout=1)
         except TimeoutExpired:
@@ -180,7 +646,12 @@ class Services:
                 p.kill()
                 p.wait()
                 filter['status'] = psutil.STATUS_DEAD
+                if trace:
+                    trace.finish("Filter did not daemonize before timeout.")
                 return False
+        else:
+            if trace:
+                trace.mark('daemonized')
 
         return True
 
@@ -205,15 +676,16 @@ class Services:
         :param no_lock: If set to True, will not lock mutex
         """
         if not no_lock:
-            self._lock.acquire()
+            self._filter_lock(filter['name']).acquire()
 
-        self.rotate_logs(filter['name'], filter['pid_file'])
-
-        if not no_lock:
-            self._lock.release()
+        try:
+            self.rotate_logs(filter['name'], filter['pid_file'])
+        finally:
+            if not no_lock:
+                self._filter_lock(filter['name']).release()
 
     @staticmethod
-    def stop(name, pid_file, socket_link=None):
+    def stop(name, pid_file, socket_link=None, timeout=None, pid=None):
         """
         Stop the filter based on his pid_file and
         remove the associated socket symlink (if provided).
@@ -221,33 +693,37 @@ class Services:
         :param name: The name of the filter.
         :param pid_file: The pid file of the filter.
         :param socket_link: The symlink to the filter socket (Optional).
+        :param timeout: Time given to the filter to exit before it is killed, in seconds.
+                        Defaults to the 'stop_timeout' of the manager configuration.
+        :param pid: The last known pid of the filter (Optional), killed if the pid file is missing.
         """
-        pid = None
+        if timeout is None:
+            timeout = manager_settings.get('stop_timeout', 10)
 
+        known_pid, pid = pid, None
         try:
             pid = Services._kill_with_pid_file(pid_file)
         except FileNotFoundError as e:
             logger.warning("No PID file found for {}. Did the filter start/crash?".format(name))
-            for proc in psutil.process_iter(attrs=["cmdline", "name", "pid"]):
-                if name in proc.info["cmdline"] and "darwin_" in proc.info["name"]:
-                    logger.warning("Filter {} found in running processes (pid {}). Killing.".format(name, proc.info['pid']))
-                    kill(proc.info['pid'], SIGTERM)
-                    pid = proc.info['pid']
+            # Only the process of this instance is killed, the primary and standby instances sharing the name
+            try:
+                if known_pid and pid_file in psutil.Process(known_pid).cmdline():
+                    logger.warning("Filter {} found in running processes (pid {}). Killing.".format(name, known_pid))
+                    kill(known_pid, SIGTERM)
+                    pid = known_pid
+            except (psutil.Error, ProcessLookupError):
+                pass
 
         except Exception as e:
             logger.error("Cannot stop filter {}: {}".format(name, e))
 
-        if pid:
-            tries = 0
-            proc_running = HeartBeat.check_process(pid)
-            while tries < 10 and proc_running:
-                sleep(1)
-                proc_running = HeartBeat.check_process(pid)
-                tries += 1
-
-            if proc_running:
-                logger.warning("filter {} did not stop, forcing.".format(name))
+        if pid and not HeartBeat.wait_process_exit(pid, timeout):
+            logger.warning("filter {} did not stop, forcing.".format(name))
+            try:
                 kill(int(pid), SIGKILL)
+                HeartBeat.wait_process_exit(pid, 1)
+            except ProcessLookupError:
+                pass
 
         if not socket_link:
             return
@@ -266,17 +742,24 @@ class Services:
         :param no_lock: If set to True, will not lock mutex
         """
         if not no_lock:
-            self._lock.acquire()
+            self._filter_lock(filter['name']).acquire()
 
         filter['status'] = psutil.STATUS_TRACING_STOP
 
+        if self._supervisor:
+            self._supervisor.unwatch(filter['name'])
+
+        self._stop_standby(filter['name'])
+
         self.stop(filter['name'], filter['pid_file'],
-                  filter['socket_link'])
+                  filter['socket_link'], pid=filter.get('pid'))
+        self._forget_process(filter['name'])
+        self._rates.restarted(filter['name'])
 
         filter['status'] = psutil.STATUS_STOPPED
 
         if not no_lock:
-            self._lock.release()
+            self._filter_lock(filter['name']).release()
 
     def restart_one(self, filter, no_lock=False):
         """
@@ -295,26 +778,42 @@ class Services:
         except Exception as e:
             logger.error("Cannot clean {}: {}".format(filter['name'], e))
 
+        trace = self._new_trace(filter, 'restart')
         try:
-            self.start_one(filter, no_lock=no_lock)
+            started = self.start_one(filter, no_lock=no_lock, trace=trace)
         except Exception as e:
             logger.error("Cannot start filter {}: {}".format(filter['name'], e))
+            started = False
+            trace.finish("cannot start filter: {}".format(e))
 
-        ret = Services._wait_process_ready(filter)
+        if started:
+            ret = Services._wait_process_ready(filter, trace=trace)
+            trace.finish(ret)
+        else:
+            # The trace was finished with the error of the start
+            ret = "Filter did not start"
         if ret:
             logger.error("Error when starting filter {}: {}".format(filter['name'], ret))
             self.stop_one(filter, no_lock=no_lock)
             self.clean_one(filter, no_lock=no_lock)
         else:
+            Services._apply_scheduling(filter)
             filter['status'] = psutil.STATUS_RUNNING
             call(['ln', '-s', filter['socket'], filter['socket_link']])
+            self._supervise(filter)
 
-    def update(self, names, prefix, suffix):
+    def update(self, names, prefix, suffix, timings=None, progress=None):
         """
         Update the filters which name are contained in names
         configuration and process.
+        The new instances of the filters are spawned concurrently.
 
         :param names: A list containing the names of the filter to update.
+        :param timings: If a dict is given, it is filled with the update durations of each filter,
+                        in seconds: the 'total' duration and the time spent draining the older instance.
+        :param progress: If a callable is given, it is called with the name of a filter and its update step
+                         each time one is reached: 'spawning', 'warming', 'switched', 'drained',
+                         'removed' or 'failed'.
         :return A empty list on success. A list containing error messages on failure.
         """
         from config import filters as conf_filters
@@ -325,7 +824,7 @@ class Services:
         except ConfParseError:
             error = "Update: wrong configuration format, unable to update"
             logger.error(error)
-            return error
+            return [{"configuration": "filters", "error": error}]
 
         logger.info("Update: Configuration loaded")
 
@@ -334,6 +833,8 @@ class Services:
             # and unpack values as a list
             # This yields a list of the new and deleted filters (by name only) = a diff of configured filters
             names = [*(set(self._filters.keys()) ^ set(conf_filters.keys()))]
+        else:
+            names = self._expand_instances_names(names, conf_filters)
 
         with self._lock:
             errors = []
@@ -344,12 +845,15 @@ class Services:
                     new[n] = conf_filters[n]
                 except KeyError:
                     try:
-                        self.stop_one(self._filters[n], no_lock=True)
-                        self.clean_one(self._filters[n], no_lock=True)
+                        with self._filter_lock(n):
+                            self.stop_one(self._filters[n], no_lock=True)
+                            self.clean_one(self._filters[n], no_lock=True)
+                        Services._progress(progress, n, 'removed')
                     except KeyError:
                         errors.append({"filter": n,
                                        "error": 'Filter not existing'})
-                    self._filters.pop(n, None)
+                        Services._progress(progress, n, 'failed')
+                    self._replace_filter(n, None)
                     continue
                 try:
                     new[n]['extension'] = '.1' if self._filters[n]['extension'] == '.2' else '.2'
@@ -376,66 +880,160 @@ class Services:
                     name=n, extension=new[n]['extension']
                 )
 
-            for n, c in new.items():
-                cmd = self._build_cmd(c)
-                try:
-                    p = Popen(cmd)
-                    p.wait(timeout=1)
-                except OSError as e:
-                    logger.error("cannot start filter: " + str(e))
-                    c['status'] = psutil.STATUS_DEAD
-                    errors.append({"filter": n, "error": "cannot start filter: {}".format(str(e))})
-                    continue
-                except TimeoutExpired:
-                    if c['log_level'].lower() == "developer":
-                        logger.debug("Debug mode enabled. Ignoring timeout at process startup.")
-                    else:
-                        logger.error("Error starting filter. Did not daemonize before timeout. Killing it.")
-                        p.kill()
-                        p.wait()
-                    errors.append({"filter": n, "error": "Filter did not daemonize before timeout."})
-                    continue
-                ret = Services._wait_process_ready(c)
-                if ret:
-                    logger.error("Unable to update filter {}: {}".format(n, ret))
-                    # Then there is an error
-                    errors.append({"filter": n, "error": ret})
-                    try:
-                        self.stop(n, c['pid_file'])
-                        self.clean_one(c, no_lock=True)
-                    except Exception:
-                        pass
-                    continue
+            # The socket of a removed multi-instance filter may be reused by a new filter
+            self._release_balancers()
 
-                c['status'] = psutil.STATUS_RUNNING
+            if new:
+                # Spawn and warm up all the new instances at the same time,
+                # each socket symlink is switched as soon as its instance is ready
+                with ThreadPoolExecutor(max_workers=len(new)) as executor:
+                    futures = [(n, executor.submit(self._timed_update_one, n, c, progress)) for n, c in new.items()]
+                    for n, future in futures:
+                        update_errors, timing = future.result()
+                        errors += update_errors
+                        if timings is not None:
+                            timings[n] = timing
 
-                logger.info("Switching filters symlink...")
+        return errors
+
+
+    def _expand_instances_names(self, names, conf_filters):
+        """
+        Add the names of the instances of the multi-instance filters to a list of filter names,
+        whether they are currently running or newly configured.
+
+        :param names: A list of filter names.
+        :param conf_filters: The filters of the new configuration.
+        :return: The list of the filters names to update.
+        """
+        expanded = []
+        for n in names:
+            instances = sorted({m for m, f in list(self._filters.items()) + list(conf_filters.items())
+                                if f.get('instance_of') == n})
+            if n in self._filters or n in conf_filters or not instances:
+                expanded.append(n)
+            expanded += [m for m in instances if m not in expanded]
+        return expanded
+
+    @staticmethod
+    def _progress(progress, name, step):
+        """
+        Report the update step reached by a filter, if a progress callable is given.
+        """
+        if progress:
+            progress(name, step)
+
+    def _timed_update_one(self, n, c, progress=None):
+        """
+        Update a filter, measuring the time it took.
+
+        :return: A tuple containing the list of errors and a dict of the update durations, in seconds.
+        """
+        timing = {'drain': 0}
+        begin = time()
+        errors = self._update_one(n, c, timing, progress)
+        timing['total'] = time() - begin
+        if errors:
+            Services._progress(progress, n, 'failed')
+        self._spawn_standby_async(n)
+        return errors, timing
+
+    def _update_one(self, n, c, timing=None, progress=None):
+        """
+        Spawn the new instance of a filter, switch its socket symlink
+        and retire the older instance once its connections are drained.
+
+        :param n: The name of the filter.
+        :param c: The dict of the new filter instance.
+        :param timing: If a dict is given, the time spent draining the older instance is set in its 'drain' key.
+        :param progress: If a callable is given, it is called with the name of the filter and each update step reached.
+        :return: A list containing the error message on failure, an empty list otherwise.
+        """
+        errors = []
+        with self._filter_lock(n):
+            # The standby instance uses the extension of the new instance
+            self._stop_standby(n)
+            current = self._filters.get(n)
+            if current and current['extension'] == c['extension']:
+                # The filter failed over to its standby instance since the update was prepared
+                c.update(Services._instance(c, Services._alternate_extension(c['extension'])))
+            cmd = self._build_cmd(c)
+            trace = self._new_trace(c, 'update')
+            Services._progress(progress, n, 'spawning')
+            try:
+                p = Popen(cmd)
+                trace.mark('spawn')
+                p.wait(timeout=1)
+                trace.mark('daemonized')
+                Services._progress(progress, n, 'warming')
+            except OSError as e:
+                logger.error("cannot start filter: " + str(e))
+                c['status'] = psutil.STATUS_DEAD
+                errors.append({"filter": n, "error": "cannot start filter: {}".format(str(e))})
+                trace.finish(errors[-1]['error'])
+                return errors
+            except TimeoutExpired:
+                if c['log_level'].lower() == "developer":
+                    logger.debug("Debug mode enabled. Ignoring timeout at process startup.")
+                else:
+                    logger.error("Error starting filter. Did not daemonize before timeout. Killing it.")
+                    p.kill()
+                    p.wait()
+                errors.append({"filter": n, "error": "Filter did not daemonize before timeout."})
+                trace.finish(errors[-1]['error'])
+                return errors
+            ret = Services._wait_process_ready(c, trace=trace)
+            trace.finish(ret)
+            if ret:
+                logger.error("Unable to update filter {}: {}".format(n, ret))
+                # Then there is an error
+                errors.append({"filter": n, "error": ret})
                 try:
-                    if call(['ln', '-sfn', c['socket'], c['socket_link']]) != 0:
-                        raise Exception('Unable to update filter\'s socket symlink')
-                except Exception as e:
-                    logger.error("Unable to link new filter {}: {}".format(n, e))
-                    errors.append({"filter": n, "error": "{0}".format(e)})
-                    try:
-                        self.stop(n, c['pid_file'])
-                        self.clean_one(c, no_lock=True)
-                    except Exception:
-                        pass
-                    continue
+                    self.stop(n, c['pid_file'], pid=c.get('pid'))
+                    self.clean_one(c, no_lock=True)
+                except Exception:
+                    pass
+                return errors
 
+            Services._apply_scheduling(c)
+            c['status'] = psutil.STATUS_RUNNING
+
+            logger.info("Switching filters symlink...")
+            try:
+                if call(['ln', '-sfn', c['socket'], c['socket_link']]) != 0:
+                    raise Exception('Unable to update filter\'s socket symlink')
+            except Exception as e:
+                logger.error("Unable to link new filter {}: {}".format(n, e))
+                errors.append({"filter": n, "error": "{0}".format(e)})
                 try:
-                    logger.info("Killing older filter...")
-                    # Call 'stop' instead of 'stop_one' to avoid deletion of socket_link
-                    self.stop(n, self._filters[n]['pid_file'])
-                    self.clean_one(self._filters[n], no_lock=True)
-                except KeyError:
-                    logger.info("no older filter to kill, finalizing...")
+                    self.stop(n, c['pid_file'], pid=c.get('pid'))
+                    self.clean_one(c, no_lock=True)
+                except Exception:
                     pass
-                self._filters[n] = deepcopy(c)
-                logger.info("successfully updated {}".format(n))
+                return errors
 
-        return errors
+            # Supervising the new instance stops supervising the older one
+            self._supervise(c)
+            Services._progress(progress, n, 'switched')
 
+            try:
+                drain = Services._drain(self._filters[n])
+                if timing is not None:
+                    timing['drain'] = drain
+                logger.info("Killing older filter...")
+                # Call 'stop' instead of 'stop_one' to avoid deletion of socket_link
+                self.stop(n, self._filters[n]['pid_file'], pid=self._filters[n].get('pid'))
+                self.clean_one(self._filters[n], no_lock=True)
+            except KeyError:
+                logger.info("no older filter to kill, finalizing...")
+                pass
+            Services._progress(progress, n, 'drained')
+            self._forget_process(n)
+            self._rates.restarted(n)
+            self._replace_filter(n, deepcopy(c))
+            self._ensure_balancer(c)
+            logger.info("successfully updated {}".format(n))
+            return errors
 
     def print_conf(self):
         """
@@ -444,25 +1042,153 @@ class Services:
         """
         pprint(self._filters)
 
-    @staticmethod
-    def get_proc_info(filter, proc_stats=[]):
+    def get_proc_info(self, filter, proc_stats=[]):
+        """
+        Get the process stats of a filter.
+
+        :param filter: The dict of the filter.
+        :param proc_stats: The process stats to get, the ones in configuration if empty.
+        :return: A dict containing the stats, empty if the process cannot be accessed.
+        """
         ret = {}
         from config import stats_reporting
         if not proc_stats:
             logger.debug("get_proc_info(): no special stats, taking ones in configuration")
             proc_stats = stats_reporting.get('proc_stats', ['memory_percent', 'cpu_percent'])
+        proc_stats = proc_stats + [k for k in Services.SCHEDULING_SETTINGS if k in filter and k not in proc_stats]
 
-        for proc in psutil.process_iter(attrs=["cmdline", "name"]):
-            if filter['name'] in proc.info["cmdline"] and "darwin_" in proc.info["name"]:
-                logger.debug("get_proc_info(): found processus {}, getting stats {}".format(filter['name'], proc_stats))
-                try:
-                    ret.update(proc.as_dict(proc_stats))
-                except Exception as e:
-                    logger.error("get_proc_info(): could not get proc info -> {}".format(e))
-                    pass
+        proc = self._process(filter)
+        if proc is None:
+            return ret
+
+        logger.debug("get_proc_info(): found processus {}, getting stats {}".format(filter['name'], proc_stats))
+        try:
+            with proc.oneshot():
+                ret.update(proc.as_dict(proc_stats))
+        except Exception as e:
+            logger.error("get_proc_info(): could not get proc info -> {}".format(e))
 
         return ret
 
+    def _process(self, filter):
+        """
+        Get the process handle of a filter, reusing the one of the previous calls while the process is the same,
+        so that the stats computed between two calls (like cpu_percent) are meaningful.
+
+        :param filter: The dict of the filter.
+        :return: The psutil.Process object, None if the process cannot be accessed.
+        """
+        pid = HeartBeat.check_pid_file(filter['pid_file'])
+        if not pid:
+            self._forget_process(filter['name'])
+            return None
+
+        proc = self._processes.get(filter['name'])
+        if proc is not None and proc.pid == pid and proc.is_running():
+            return proc
+
+        try:
+            proc = psutil.Process(pid)
+        except psutil.Error as e:
+            logger.debug("get_proc_info(): process of filter {} not accessible: {}".format(filter['name'], e))
+            self._forget_process(filter['name'])
+            return None
+        self._processes[filter['name']] = proc
+        return proc
+
+    def _forget_process(self, name):
+        """
+        Drop the process handle of a filter, its process being replaced or stopped.
+
+        :param name: The name of the filter.
+        """
+        self._processes.pop(name, None)
+
+
+    @staticmethod
+    def monitor_many(files, timeout=None):
+        """
+        Get the monitoring info from several filters at the same time, in a single selector loop.
+
+        :param files: The fullpaths of the monitoring sockets to connect to.
+        :param timeout: The time all the filters have to answer, in seconds.
+                        Defaults to the 'monitoring_timeout' of the manager configuration.
+        :return: A dict associating each socket path to its monitoring data,
+                 None if it could not be acquired, or 'timeout' if the filter did not answer in time.
+        """
+        if timeout is None:
+            timeout = manager_settings.get('monitoring_timeout', 1)
+        deadline = time() + timeout
+        results = {}
+        buffers = {}
+
+        with selectors.DefaultSelector() as selector:
+            for file in files:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                try:
+                    # Unix sockets connect at once: EAGAIN means the listen backlog of the filter is full,
+                    # and the connection failed rather than being in progress
+                    sock.connect(file)
+                except OSError as e:
+                    logger.warning("Cannot connect to monitoring socket {} : {}".format(file, e))
+                    results[file] = None
+                    sock.close()
+                    continue
+                buffers[file] = bytearray()
+                selector.register(sock, selectors.EVENT_READ, file)
+
+            while selector.get_map():
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                for key, _ in selector.select(remaining):
+                    file = key.data
+                    try:
+                        chunk = key.fileobj.recv(4096)
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        logger.error("Filter monitoring data not received: {}".format(e))
+                        chunk = None
+
+                    if chunk:
+                        buffers[file] += chunk
+                        if b'}' not in chunk:
+                            continue
+                        data = Services._decode_monitoring(buffers[file])
+                        if data is None:
+                            continue
+                        results[file] = data
+                    elif chunk is not None:
+                        results[file] = Services._decode_monitoring(buffers[file])
+                        if results[file] is None:
+                            logger.error("Filter monitoring data not received: incomplete data")
+                    else:
+                        results[file] = None
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+            for key in list(selector.get_map().values()):
+                logger.warning("Filter monitoring socket {} did not answer in time".format(key.data))
+                results[key.data] = 'timeout'
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+
+        return results
+
+    @staticmethod
+    def _decode_monitoring(data):
+        """
+        Decode the monitoring data of a filter.
+
+        :return: The decoded dict, None if the data is not a complete JSON object.
+        """
+        try:
+            decoded = json.loads(data.decode().strip(' \t\r\n\x00'))
+        except ValueError:
+            return None
+        return decoded if isinstance(decoded, dict) else None
 
     @staticmethod
     def monitor_one(file):
@@ -472,97 +1198,259 @@ class Services:
         :param file: The fullpath of the management socket to connect to.
         :return: Acquired monitoring data on success, None otherwise.
         """
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        try:
-            logger.debug("Connecting to monitoring socket...")
-            sock.connect(file)
-        except Exception as e:
-            logger.warning("Cannot connect to monitoring socket {} : {}".format(file, e))
-            return
+        data = Services.monitor_many([file]).get(file)
+        logger.debug("received data: '{}'".format(data))
+        return data if data != 'timeout' else None
 
-        try:
-            #TODO implement select() method to get timeout errors and not hang
-            data = JsonSocket(sock).recv()
-            logger.debug("received data: '{}'".format(data))
-        except Exception as e:
-            logger.error("Filter monitoring data not received: {}".format(e))
-            return
-        return data
-
-    def monitor_all(self, proc_stats=[]):
+    def monitor_all(self, proc_stats=[], startup_traces=False, max_age_ms=0, filters=None, fields=None):
         """
         Get monitoring data from all the filters.
+        The data is collected once for all the concurrent callers, and can be served from
+        the last collection if it is recent enough.
+
+        :param startup_traces: If set to True, the last startup traces of each filter are added to its data.
+        :param max_age_ms: The maximum age of the data, in milliseconds.
+        :param filters: The names of the filters to monitor, all the filters if empty.
+        :param fields: The per filter fields to get, all the fields if empty.
+                       The monitoring sockets and the processes are only queried for the fields they provide.
+        :return: A dict containing the monitoring data. The 'rates' of each filter are derived from its counters
+                 since the previous collection, see RateTracker, and its 'latency' percentiles from the latency
+                 histograms of its monitoring socket, see LatencyHistogram.
+        """
+        key = (tuple(proc_stats), tuple(sorted(filters or [])), tuple(sorted(fields or [])))
+        table, snapshot = self._monitoring_cache.get(key, max_age_ms / 1000)
+        monitor_data = {n: dict(data) for n, data in snapshot.items()}
+        if startup_traces and (not fields or 'startup_traces' in fields):
+            for n, traces in self.startup_traces(list(monitor_data.keys())).items():
+                monitor_data[n]['startup_traces'] = traces
+        monitor_data = Services._aggregate_instances(table, monitor_data)
+        if not fields or 'latency' in fields:
+            Services._summarize_latencies(monitor_data)
+        if fields:
+            monitor_data = Services._select_fields(monitor_data, fields)
+        return monitor_data
+
+    def _collect_monitoring(self, key):
+        """
+        Collect the monitoring data of the filters.
 
-        :return: A dict containing the monitoring data.
+        :param key: A tuple of the process stats to collect, the names of the filters to monitor
+                    and the fields to collect, empty for all of them.
+        :return: A tuple of the filters table the data was collected from, and the data of each filter.
         """
+        proc_stats, names, fields = [list(k) for k in key]
+        query_socket = not fields or any(f in fields for f in Services.MONITORING_SOCKET_FIELDS)
         monitor_data = {}
-        with self._lock:
-            for n, c in self._filters.items():
-                monitor_data[n] = Services.monitor_one(c['monitoring'])
-                if monitor_data[n]:
-                    monitor_data[n]['failures'] = c['failures']
-                    monitor_data[n]['proc_stats'] = Services.get_proc_info(c, proc_stats)
-                else:
-                    monitor_data[n] = {}
-                    monitor_data[n]['status'] = 'error'
+        filters = self._filters
+        selected = {n: c for n, c in filters.items()
+                    if not names or n in names or c.get('instance_of') in names}
+        # Query all the monitoring sockets at the same time
+        answers = Services.monitor_many([c['monitoring'] for c in selected.values()]) if query_socket else {}
+        now = monotonic()
+        self._rates.prune(filters)
+        for n, c in selected.items():
+            monitor_data[n] = answers.get(c['monitoring']) if query_socket else {}
+            if monitor_data[n] == 'timeout':
+                monitor_data[n] = {'status': 'timeout', 'failures': c['failures']}
+            elif monitor_data[n] is not None:
+                monitor_data[n]['failures'] = c['failures']
+                if not fields or 'proc_stats' in fields:
+                    monitor_data[n]['proc_stats'] = self.get_proc_info(c, proc_stats)
+                if c.get('standby') and (not fields or 'standby' in fields):
+                    monitor_data[n]['standby'] = 'ready' if self._standby_running(n) else 'unavailable'
+                if manager_settings.get('cgroup_root') and (not fields or 'cgroup' in fields):
+                    monitor_data[n]['cgroup'] = Cgroup.stats(manager_settings['cgroup_root'], c)
+                if query_socket:
+                    rates = self._rates.update(n, monitor_data[n], now)
+                    if not fields or 'rates' in fields:
+                        monitor_data[n]['rates'] = rates
+                if 'latency' in monitor_data[n]:
+                    # The filters send the latency right after their counters: report it last,
+                    # so that the counters are still followed by the failures and process stats
+                    monitor_data[n]['latency'] = monitor_data[n].pop('latency')
+            else:
+                monitor_data[n] = {}
+                monitor_data[n]['status'] = 'error'
+        return filters, monitor_data
+
+    @staticmethod
+    def _select_fields(monitor_data, fields):
+        """
+        Keep only the selected fields of the monitoring data of each filter and filter instance.
+
+        :param monitor_data: The monitoring data of the filters.
+        :param fields: The fields to keep.
+        :return: The selected monitoring data.
+        """
+        selected = {}
+        for n, data in monitor_data.items():
+            selected[n] = {k: v for k, v in data.items() if k in fields}
+            if 'instances' in data:
+                selected[n]['instances'] = {i: {k: v for k, v in d.items() if k in fields}
+                                            for i, d in data['instances'].items()}
+        return selected
+
+    @staticmethod
+    def _summarize_latencies(monitor_data):
+        """
+        Replace the latency histograms of each filter and filter instance by their count, average and percentiles.
+
+        :param monitor_data: The monitoring data of the filters, modified in place.
+        """
+        for data in monitor_data.values():
+            for d in [data] + list(data.get('instances', {}).values()):
+                if isinstance(d.get('latency'), dict):
+                    d['latency'] = LatencyHistogram.summary(d['latency'])
+
+    @staticmethod
+    def _aggregate_instances(filters, monitor_data):
+        """
+        Report the monitoring data of the multi-instance filters under the filter name,
+        summing the counters of the instances.
+
+        :param filters: The filters table the monitoring data was collected from.
+        :param monitor_data: The monitoring data of each filter.
+        :return: The monitoring data, with the instances grouped by filter.
+        """
+        for n, c in filters.items():
+            name = c.get('instance_of')
+            if not name or n not in monitor_data:
+                continue
+            data = monitor_data.pop(n)
+            aggregated = monitor_data.setdefault(name, {'status': None, 'failures': 0, 'instances': {}})
+            aggregated['instances'][n] = data
+            aggregated['failures'] += c['failures']
+            for counter in Services.MONITORING_COUNTERS:
+                aggregated[counter] = aggregated.get(counter, 0) + data.get(counter, 0)
+            if 'rates' in data:
+                aggregated['rates'] = RateTracker.combine([aggregated.get('rates', {}), data['rates']])
+            if 'latency' in data:
+                aggregated['latency'] = LatencyHistogram.merge([aggregated.get('latency', {}), data['latency']])
+
+            if aggregated['status'] is None:
+                aggregated['status'] = data.get('status')
+            elif aggregated['status'] != data.get('status'):
+                aggregated['status'] = 'degraded'
         return monitor_data
 
     @staticmethod
-    def _wait_process_ready(content):
+    def _wait_process_ready(content, timeout=None, trace=None):
         """
         Check that the passed process is up and running.
+        Wakes up on filesystem events in the run and sockets directories,
+        and probes the monitoring socket with an exponential backoff.
 
         :param content: Dict containing the filter configuration.
+        :param timeout: Time to wait for the filter, in seconds.
+                        Defaults to the 'ready_timeout' of the manager configuration.
+        :param trace: If a StartupTrace is given, the readiness phases reached are recorded in it.
         :return: None on success, a str containing the error message on error.
         """
         logger.debug("entered _wait_process_ready")
-        retries = 0
-        status = "Not None"
-        while status and retries < 3:
-            retries += 1
-            status = None
-            sleep(0.2)
-            pid = HeartBeat.check_pid_file(content['pid_file'])
-
-            if not pid:
-                status = "PID file not accessible"
-                continue
-
-            if not HeartBeat.check_process(pid):
-                status = "Process not running"
-                continue
+        if timeout is None:
+            timeout = manager_settings.get('ready_timeout', 10)
+        deadline = time() + timeout
+
+        directories = {dirname(content['pid_file']), dirname(content['monitoring']), dirname(content['socket'])}
+        with DirectoryWatcher(directories) as watcher:
+            probe_delay = Services.READY_PROBE_MIN_DELAY
+            attached_pid = None
+            while True:
+                status = None
+                pid = HeartBeat.check_pid_file(content['pid_file'])
+
+                if not pid:
+                    status = "PID file not accessible"
+                elif not HeartBeat.check_process(pid):
+                    return "Process not running"
+                else:
+                    if trace:
+                        trace.mark('pid_file')
+                    if pid != attached_pid:
+                        # Isolate the filter as soon as it is daemonized, before it loads its resources
+                        Services._attach_cgroup(content, pid)
+                        attached_pid = pid
+                        # Kept to stop the filter if its pid file goes missing
+                        content['pid'] = pid
+                    status = Services._probe_ready(content, deadline, trace)
+
+                if not status:
+                    return None
+
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return status
+
+                watcher.wait(min(probe_delay, remaining))
+                probe_delay = min(probe_delay * 2, Services.READY_PROBE_MAX_DELAY)
 
-            if not HeartBeat.check_socket(content['monitoring']):
-                status = "Monitoring socket not created"
-                continue
+    @staticmethod
+    def _probe_ready(content, deadline, trace=None):
+        """
+        Probe the sockets of a running filter process.
 
-        if status:
-            return status
-
-        status = "Not None"
-        retries = 0
-        while status and retries < 10:
-            status = None
-            retries += 1
-            sleep(1)
-            resp = Services._get_monitoring_info(content['monitoring'])
-            if not resp:
-                status = "Monitoring socket not ready"
-                continue
+        :param content: Dict containing the filter configuration.
+        :param deadline: The time after which the monitoring socket is not waited for anymore.
+        :param trace: If a StartupTrace is given, the phases reached are recorded in it.
+        :return: None if the filter is ready, a str containing the reason otherwise.
+        """
+        if not HeartBeat.check_socket(content['monitoring']):
+            return "Monitoring socket not created"
+
+        resp = Services._get_monitoring_info(content['monitoring'], timeout=min(max(deadline - time(), 0.01), 1))
+        if not resp:
+            return "Monitoring socket not ready"
+        if trace:
+            trace.mark('monitoring_socket')
+        if "running" not in resp:
+            return "Filter not ready"
+        if trace:
+            trace.mark('running')
+        if not HeartBeat.check_socket(content['socket']):
+            return "Main socket not created"
+        if trace:
+            trace.mark('main_socket')
+        return None
 
-            if "running" in resp:
-                if not HeartBeat.check_socket(content['socket']):
-                    status = "Main socket not created"
-                    continue
-            else:
-                status = "Filter not ready"
-                continue
+    @staticmethod
+    def _drain(filter, timeout=None):
+        """
+        Wait for the clients of a filter instance to close their connections,
+        based on the 'connections' counter of its monitoring data.
 
-        return status
+        :param filter: The dict of the filter instance.
+        :param timeout: The maximum time to wait, in seconds.
+                        Defaults to the 'drain_timeout' of the manager configuration.
+        :return: The time spent draining, in seconds.
+        """
+        if timeout is None:
+            timeout = manager_settings.get('drain_timeout', 5)
+        begin = time()
+        if timeout <= 0:
+            return 0
+
+        deadline = begin + timeout
+        probe_delay = Services.DRAIN_PROBE_MIN_DELAY
+        while True:
+            data = Services.monitor_one(filter['monitoring'])
+            if not data or not data.get('connections'):
+                break
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                logger.warning("Filter {} still has {} connection(s) after draining for {}s".format(
+                    filter['name'], data['connections'], timeout))
+                break
+
+            sleep(min(probe_delay, remaining))
+            probe_delay = min(probe_delay * 2, Services.DRAIN_PROBE_MAX_DELAY)
+
+        return time() - begin
 
     def hb_one(self, filter):
         """
         Perform HB to the passed and restart it if needed.
+        The restart is done in its own thread, so that it doesn't delay the other filters.
 
         :param filter: The dict object representing the filter.
         """
@@ -585,22 +1473,28 @@ class Services:
             logger.warning("HeartBeat failed on {} ({}). Restarting the filter.".format(filter['name'], e))
             filter['failures'] += 1
             filter['status'] = psutil.STATUS_DEAD
-            self.restart_one(filter, no_lock=True)
+            Thread(target=self._restart_failed, args=(filter, str(e)), daemon=True).start()
 
     def hb_all(self):
         """
         Loop over all the filters to check heartbeat.
         Restart the filter in case of error.
+        Filters with a lifecycle operation in progress are skipped.
         """
 
-        with self._lock:
-            for _, c in self._filters.items():
-                if c['status'] != psutil.STATUS_STOPPED:
+        for n, c in self._filters.items():
+            lock = self._filter_lock(n)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                if c['status'] not in [psutil.STATUS_STOPPED, psutil.STATUS_DEAD]:
                     self.hb_one(c)
+            finally:
+                lock.release()
 
     def clean_one(self, content, no_lock=False):
         if not no_lock:
-            self._lock.acquire()
+            self._filter_lock(content['name']).acquire()
         try:
             if access(content['pid_file'], F_OK):
                 remove(content['pid_file'])
@@ -619,37 +1513,33 @@ class Services:
         except Exception as e:
             logger.error("Cannot delete leftover monitor socket: {}".format(e))
 
+        if manager_settings.get('cgroup_root'):
+            Cgroup.remove(manager_settings['cgroup_root'], content)
+
         if not no_lock:
-            self._lock.release()
+            self._filter_lock(content['name']).release()
 
     def clean_all(self):
-        with self._lock:
-            for _, c in self._filters.items():
-                self.clean_one(c, no_lock=True)
+        for _, c in self._filters.items():
+            self.clean_one(c)
 
     @staticmethod
-    def _get_monitoring_info(socket_path):
+    def _get_monitoring_info(socket_path, timeout=1):
         """
         Sends a request to a socket and returns the answer.
-        :param request: the binary formatted request
         :param socket_path: the fullpath to the socket file
+        :param timeout: the socket operations timeout, in seconds
         :return: the answer as a string or None if no answer could be received
         """
 
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
 
         try:
             sock.connect(socket_path)
-        except socket.error:
-            return None
-        try:
             sock.sendall(b'')
+            return sock.recv(4096).decode()
         except Exception:
             return None
-
-        try:
-            response = sock.recv(4096).decode()
-        except Exception:
-            return None
-
-        return response
+        finally:
+            sock.close()
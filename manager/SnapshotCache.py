@@ -0,0 +1,82 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Shared cache of collected snapshots'
+
+from collections import OrderedDict
+from threading import Lock, Event
+from time import monotonic
+
+
+class SnapshotCache:
+    """
+    Cache of the snapshots returned by a collection function, by collection key.
+
+    A single reader collects a stale snapshot at a time: the readers arriving
+    while it is being collected wait for it and share its result.
+    As the keys come from the requests, only the snapshots of the last used keys are kept.
+    """
+
+    # Default number of snapshots kept
+    SIZE = 32
+
+    def __init__(self, collect, size=SIZE):
+        """
+        Constructor.
+
+        :param collect: Callable taking a collection key and returning the snapshot for this key.
+        :param size: The number of snapshots kept, the least recently used ones being dropped first.
+        """
+        self._collect = collect
+        self._size = size
+        self._lock = Lock()
+        # key -> (collection time, snapshot), least recently used first
+        self._snapshots = OrderedDict()
+        # key -> Event set when the ongoing collection ends
+        self._collecting = {}
+
+    def get(self, key, max_age):
+        """
+        Get the snapshot of a key, collecting it if the cached one is older than max_age.
+
+        :param key: The collection key.
+        :param max_age: The maximum age of the snapshot, in seconds.
+        :return: The snapshot.
+        """
+        with self._lock:
+            cached = self._snapshots.get(key)
+            if cached and monotonic() - cached[0] <= max_age:
+                self._snapshots.move_to_end(key)
+                return cached[1]
+            collecting = self._collecting.get(key)
+            if collecting is None:
+                collecting = self._collecting[key] = Event()
+                collector = True
+            else:
+                collector = False
+
+        if not collector:
+            collecting.wait()
+            with self._lock:
+                cached = self._snapshots.get(key)
+            if cached:
+                return cached[1]
+            # The collection failed, collect for this reader
+            return self._collect(key)
+
+        begin = monotonic()
+        try:
+            snapshot = self._collect(key)
+            with self._lock:
+                self._snapshots[key] = (begin, snapshot)
+                self._snapshots.move_to_end(key)
+                while len(self._snapshots) > self._size:
+                    self._snapshots.popitem(last=False)
+            return snapshot
+        finally:
+            with self._lock:
+                del self._collecting[key]
+            collecting.set()
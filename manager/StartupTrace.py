@@ -0,0 +1,64 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Filters startup phases timing'
+
+from collections import OrderedDict
+from time import time
+
+
+class StartupTrace:
+    """
+    Timestamps of the phases of a filter startup, relative to the beginning of the operation.
+    The phases are, in order: 'spawn', 'daemonized', 'pid_file', 'monitoring_socket', 'running', 'main_socket'.
+    """
+
+    def __init__(self, name, operation):
+        """
+        Constructor, start the trace.
+
+        :param name: The name of the filter instance.
+        :param operation: The operation starting the filter ('start', 'restart', 'update' or 'standby').
+        """
+        self.name = name
+        self.operation = operation
+        self._begin = time()
+        self._phases = OrderedDict()
+        self._total = None
+        self._error = None
+
+    def mark(self, phase):
+        """
+        Record the time a phase was reached, only the first time it is.
+
+        :param phase: The name of the phase.
+        """
+        if phase not in self._phases:
+            self._phases[phase] = round(time() - self._begin, 6)
+
+    def finish(self, error=None):
+        """
+        End the trace.
+
+        :param error: The error which stopped the startup, if any.
+        """
+        self._total = round(time() - self._begin, 6)
+        self._error = error
+
+    def to_dict(self):
+        """
+        :return: A dict describing the trace, with the phases times in seconds.
+        """
+        trace = {
+            'filter': self.name,
+            'operation': self.operation,
+            'started': self._begin,
+            'phases': dict(self._phases),
+            'total': self._total
+        }
+        if self._error:
+            trace['error'] = self._error
+        return trace
@@ -0,0 +1,201 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'In-memory time series of the filters stats'
+
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+
+
+class _FilterHistory:
+    """
+    Fixed-size ring buffer of the samples of a filter.
+    The sample times and the values of each metric are held in arrays of doubles sharing the same slots,
+    a metric missing from a sample being stored as NaN.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._times = array('d', [math.nan]) * size
+        self._values = {}
+        # Slot of the next sample, and number of samples held
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        """
+        :return: The time of the index-th oldest sample, so that the buffer can be bisected.
+        """
+        return self._times[self._slot(index)]
+
+    def _slot(self, index):
+        return (self._next - self._count + index) % self._size
+
+    def append(self, now, sample):
+        """
+        Add a sample, overwriting the oldest one when the buffer is full.
+
+        :param now: The time of the sample.
+        :param sample: A dict of the metric values.
+        """
+        slot = self._next
+        self._times[slot] = now
+        for metric, values in self._values.items():
+            values[slot] = sample.get(metric, math.nan)
+        for metric in sample:
+            if metric not in self._values:
+                values = self._values[metric] = array('d', [math.nan]) * self._size
+                values[slot] = sample[metric]
+        self._next = (slot + 1) % self._size
+        self._count = min(self._count + 1, self._size)
+
+    def metrics(self):
+        return list(self._values.keys())
+
+    def range(self, metrics, start, end):
+        """
+        :return: The list of the sample times between start and end included,
+                 and the dict of the values of each metric at these times.
+        """
+        first = bisect_left(self, start) if start is not None else 0
+        last = bisect_right(self, end) if end is not None else self._count
+        slots = [self._slot(i) for i in range(first, last)]
+        return ([self._times[s] for s in slots],
+                {m: [self._values[m][s] for s in slots] for m in metrics if m in self._values})
+
+
+class StatsHistory:
+    """
+    Recent history of the numeric stats of each filter, held in memory.
+
+    Each filter has a ring buffer of 'size' samples. The stats are flattened into metrics named
+    after their path in the monitoring data, like 'received', 'rates.events_per_s' or 'proc_stats.cpu_percent'.
+    The history can be queried by time range, and downsampled into min/max/avg buckets.
+    """
+
+    # Monitoring data not sampled
+    EXCLUDED_FIELDS = ['instances', 'startup_traces']
+
+    def __init__(self, size):
+        """
+        Constructor.
+
+        :param size: The number of samples kept per filter.
+        """
+        self._size = size
+        self._lock = Lock()
+        self._filters = {}
+
+    @staticmethod
+    def _flatten(data, prefix='', sample=None):
+        """
+        Flatten the numeric values of the monitoring data of a filter.
+
+        :return: A dict of the values by metric name.
+        """
+        sample = {} if sample is None else sample
+        for key, value in data.items():
+            if not prefix and key in StatsHistory.EXCLUDED_FIELDS:
+                continue
+            name = prefix + str(key)
+            if hasattr(value, '_asdict'):
+                value = value._asdict()
+            if isinstance(value, dict):
+                StatsHistory._flatten(value, name + '.', sample)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                sample[name] = float(value)
+            elif value is None:
+                sample[name] = math.nan
+        return sample
+
+    def record(self, monitor_data, now):
+        """
+        Add a sample of the stats of the filters, forgetting the filters not monitored anymore.
+
+        :param monitor_data: The monitoring data of the filters, as returned by Services.monitor_all.
+        :param now: The time of the sample.
+        """
+        samples = {n: StatsHistory._flatten(data) for n, data in monitor_data.items()}
+        with self._lock:
+            for name in [n for n in self._filters if n not in samples]:
+                del self._filters[name]
+            for name, sample in samples.items():
+                history = self._filters.get(name)
+                if history is None:
+                    history = self._filters[name] = _FilterHistory(self._size)
+                history.append(now, sample)
+
+    @staticmethod
+    def _number(value):
+        return None if math.isnan(value) else value
+
+    @staticmethod
+    def _downsample(times, values, start, step):
+        """
+        Group the samples in buckets of 'step' seconds, starting at 'start'.
+
+        :return: The list of the start times of the non-empty buckets,
+                 and the dict of the min, max and avg lists of each metric.
+        """
+        buckets = []
+        for i, t in enumerate(times):
+            bucket = start + math.floor((t - start) / step) * step
+            if not buckets or buckets[-1][0] != bucket:
+                buckets.append((bucket, i, i + 1))
+            else:
+                buckets[-1] = (bucket, buckets[-1][1], i + 1)
+
+        downsampled = {}
+        for metric, series in values.items():
+            stats = downsampled[metric] = {'min': [], 'max': [], 'avg': []}
+            for _, first, last in buckets:
+                points = [v for v in series[first:last] if not math.isnan(v)]
+                stats['min'].append(min(points) if points else None)
+                stats['max'].append(max(points) if points else None)
+                stats['avg'].append(sum(points) / len(points) if points else None)
+        return [b[0] for b in buckets], downsampled
+
+    def query(self, names=None, metrics=None, start=None, end=None, step=None):
+        """
+        Get the history of the filters.
+
+        :param names: The names of the filters, all the filters if empty.
+        :param metrics: The metrics to get, all of them if empty.
+                        A name also selects the metrics under it, 'rates' selecting 'rates.events_per_s'...
+        :param start: The time of the oldest sample to get, the oldest sample held if None.
+        :param end: The time of the newest sample to get, the newest sample held if None.
+        :param step: If set, the samples are downsampled into buckets of 'step' seconds.
+        :return: A dict containing, for each filter, the sample times in 'time' and the values of each metric
+                 in 'metrics', as lists. When downsampled, each metric holds 'min', 'max' and 'avg' lists,
+                 'time' holding the start times of the buckets. Missing values are None.
+        """
+        if step is not None and step <= 0:
+            raise ValueError('Invalid history step: {}'.format(step))
+
+        history = {}
+        with self._lock:
+            for name, filter_history in self._filters.items():
+                if names and name not in names:
+                    continue
+                selected = [m for m in filter_history.metrics()
+                            if not metrics or any(m == s or m.startswith(s + '.') for s in metrics)]
+                history[name] = filter_history.range(selected, start, end)
+
+        for name, (times, values) in history.items():
+            if step is not None and times:
+                times, downsampled = StatsHistory._downsample(times, values, times[0] if start is None else start,
+                                                              step)
+                history[name] = {'time': times, 'metrics': downsampled}
+            else:
+                history[name] = {'time': times,
+                                 'metrics': {m: [StatsHistory._number(v) for v in series]
+                                             for m, series in values.items()}}
+        return history
@@ -0,0 +1,137 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Stats subscriptions of the administration clients'
+
+import logging
+from collections import deque
+from threading import Lock
+from uuid import uuid4
+
+logger = logging.getLogger()
+
+
+class Subscription:
+    """
+    A client subscribed to the filters stats.
+
+    At each interval, the changes of the selected stats since the previous push
+    are sent to the client as a newline-delimited JSON message:
+    {"subscription": <id>, "time": <timestamp>, "delta": {<filter>: {<field>: <new value>}}}
+    The first message holds all the selected stats. Removed filters and fields are set to null,
+    and no message is sent when nothing changed.
+
+    The messages are queued and sent by a sender executor, so that a slow client does not delay
+    the reporter. A client falling MAX_QUEUED messages behind is unsubscribed.
+    """
+
+    MIN_INTERVAL = 0.1
+    MAX_QUEUED = 8
+
+    def __init__(self, cli, interval, now, filters=None, fields=None, request_id=None):
+        """
+        Constructor.
+
+        :param cli: The client JsonSocket.
+        :param interval: The interval between two pushes, in seconds.
+        :param now: The current time, the first push is due immediately.
+        :param filters: The names of the filters to send the stats of, all the filters if empty.
+        :param fields: The per filter fields to send, all the fields if empty.
+        :param request_id: The id of the subscribe command, added to the messages if given.
+        """
+        self.id = uuid4().hex
+        self.interval = max(float(interval), self.MIN_INTERVAL)
+        self.next_due = now
+        self.cli = cli
+        self._filters = set(filters) if filters else None
+        self._fields = set(fields) if fields else None
+        self._request_id = request_id
+        self._last = {}
+        self._queue = deque()
+        self._lock = Lock()
+        self._sending = False
+        self._failed = False
+
+    def _select(self, stats):
+        return {
+            n: {k: v for k, v in data.items() if not self._fields or k in self._fields}
+            for n, data in stats.items() if not self._filters or n in self._filters
+        }
+
+    @staticmethod
+    def _delta(old, new):
+        """
+        Compute the changes between two dicts, recursively.
+
+        :return: A dict of the changed and added values, the removed keys being set to None.
+        """
+        delta = {}
+        for k, v in new.items():
+            if k not in old:
+                delta[k] = v
+            elif isinstance(v, dict) and isinstance(old[k], dict):
+                changes = Subscription._delta(old[k], v)
+                if changes:
+                    delta[k] = changes
+            elif old[k] != v:
+                delta[k] = v
+        for k in old:
+            if k not in new:
+                delta[k] = None
+        return delta
+
+    def push(self, stats, now, senders):
+        """
+        Queue the changes of the stats for the client, and schedule the next push.
+
+        :param stats: The monitoring data of all the filters.
+        :param now: The collection time of the stats.
+        :param senders: The executor sending the queued messages.
+        :return: False if the client cannot be reached anymore or is too slow, True otherwise.
+        """
+        self.next_due = max(self.next_due + self.interval, now)
+
+        view = self._select(stats)
+        delta = Subscription._delta(self._last, view)
+        self._last = view
+        if self._failed:
+            return False
+        if not delta:
+            return True
+
+        message = {'subscription': self.id, 'time': now, 'delta': delta}
+        if self._request_id is not None:
+            message['id'] = self._request_id
+        with self._lock:
+            if len(self._queue) >= self.MAX_QUEUED:
+                logger.info("Subscription {}: client too slow, unsubscribing".format(self.id))
+                return False
+            self._queue.append(message)
+            if self._sending:
+                return True
+            self._sending = True
+        try:
+            senders.submit(self._send)
+        except RuntimeError:
+            # The server is stopping
+            return False
+        return True
+
+    def _send(self):
+        """
+        Send the queued messages to the client.
+        """
+        while True:
+            with self._lock:
+                if not self._queue or self._failed:
+                    self._sending = False
+                    return
+                message = self._queue.popleft()
+            try:
+                self.cli.send_line(message)
+            except Exception as e:
+                logger.info("Subscription {}: client unreachable, unsubscribing: {}".format(self.id, e))
+                self._failed = True
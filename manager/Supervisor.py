@@ -0,0 +1,178 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Filter processes supervision class'
+
+import logging
+import os
+import select
+import ctypes
+import ctypes.util
+from threading import Lock
+from HeartBeat import HeartBeat
+
+logger = logging.getLogger()
+
+# prctl(2) option, see <linux/prctl.h>
+PR_SET_CHILD_SUBREAPER = 36
+
+
+class Supervisor:
+    """
+    Track the filter processes and get notified as soon as one of them exits.
+
+    On Linux, the manager becomes a child subreaper, so that the daemonized filters
+    are re-parented to it, and their pidfds are polled with epoll.
+    On BSD systems, process exits are watched with kqueue.
+    """
+
+    def __init__(self, on_exit):
+        """
+        Constructor, set up the supervision backend.
+
+        :param on_exit: Callable called with the filter name and pid when a supervised process exits.
+        """
+        self._on_exit = on_exit
+        self._lock = Lock()
+        self._epoll = None
+        self._kqueue = None
+        # name -> (pid, pidfd or None)
+        self._watched = {}
+        # pidfd or pid -> name
+        self._idents = {}
+
+        if hasattr(select, 'epoll') and self._pidfd_supported():
+            self._set_subreaper()
+            self._epoll = select.epoll()
+        elif hasattr(select, 'kqueue'):
+            self._kqueue = select.kqueue()
+        else:
+            logger.warning("Supervisor: no process supervision backend available on this system")
+
+    @property
+    def available(self):
+        """
+        Whether process exits can be watched on this system.
+        """
+        return self._epoll is not None or self._kqueue is not None
+
+    @staticmethod
+    def _pidfd_supported():
+        try:
+            fd = HeartBeat.open_pidfd(os.getpid())
+        except OSError:
+            return False
+        if fd is None:
+            return False
+        os.close(fd)
+        return True
+
+    @staticmethod
+    def _set_subreaper():
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+        except (OSError, AttributeError) as e:
+            logger.warning("Supervisor: cannot become child subreaper: {}".format(e))
+
+    def watch(self, name, pid):
+        """
+        Start supervising a filter process, replacing any process previously supervised under this name.
+
+        :param name: The name of the filter.
+        :param pid: The pid of the filter process.
+        """
+        self.unwatch(name)
+
+        with self._lock:
+            try:
+                if self._epoll is not None:
+                    fd = HeartBeat.open_pidfd(pid)
+                    self._watched[name] = (pid, fd)
+                    self._idents[fd] = name
+                    self._epoll.register(fd, select.EPOLLIN)
+                elif self._kqueue is not None:
+                    self._watched[name] = (pid, None)
+                    self._idents[pid] = name
+                    self._kqueue.control([select.kevent(
+                        pid,
+                        filter=select.KQ_FILTER_PROC,
+                        flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                        fflags=select.KQ_NOTE_EXIT
+                    )], 0)
+                else:
+                    return
+            except ProcessLookupError:
+                exited = True
+            else:
+                exited = False
+                logger.debug("Supervisor: watching filter {} (pid {})".format(name, pid))
+
+        if exited:
+            self._forget(name)
+            self._on_exit(name, pid)
+
+    def unwatch(self, name):
+        """
+        Stop supervising a filter process.
+
+        :param name: The name of the filter.
+        """
+        pid, fd = self._forget(name)
+        if pid is None:
+            return
+
+        try:
+            if fd is not None:
+                self._epoll.unregister(fd)
+                os.close(fd)
+            elif self._kqueue is not None:
+                self._kqueue.control([select.kevent(pid, filter=select.KQ_FILTER_PROC, flags=select.KQ_EV_DELETE)], 0)
+        except (OSError, ValueError):
+            pass
+
+    def _forget(self, name):
+        with self._lock:
+            pid, fd = self._watched.pop(name, (None, None))
+            self._idents.pop(fd if fd is not None else pid, None)
+        return pid, fd
+
+    def poll(self, timeout):
+        """
+        Wait for supervised processes to exit, and call the exit callback for each of them.
+
+        :param timeout: The maximum time to wait, in seconds.
+        """
+        if self._epoll is not None:
+            idents = [fd for fd, _ in self._epoll.poll(timeout)]
+        elif self._kqueue is not None:
+            idents = [event.ident for event in self._kqueue.control(None, 16, timeout)]
+        else:
+            return
+
+        for ident in idents:
+            with self._lock:
+                name = self._idents.get(ident)
+                pid = self._watched[name][0] if name is not None else None
+            if name is None:
+                continue
+            self.unwatch(name)
+            HeartBeat.reap(pid)
+            logger.debug("Supervisor: filter {} (pid {}) exited".format(name, pid))
+            self._on_exit(name, pid)
+
+    def close(self):
+        """
+        Stop all supervision and release the associated resources.
+        """
+        for name in list(self._watched.keys()):
+            self.unwatch(name)
+        if self._epoll is not None:
+            self._epoll.close()
+        if self._kqueue is not None:
+            self._kqueue.close()
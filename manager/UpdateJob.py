@@ -0,0 +1,115 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Asynchronous filters update jobs'
+
+from collections import OrderedDict
+from threading import Condition
+from time import time
+from uuid import uuid4
+
+
+class UpdateJob:
+    """
+    A filters update running in the background, tracking the update step reached by each filter.
+    The job is 'pending' until it starts, 'running', then 'done' or 'failed' if any filter failed.
+    """
+
+    def __init__(self, names):
+        """
+        Constructor.
+
+        :param names: The names of the filters to update, empty to update every changed filter.
+        """
+        self.id = uuid4().hex
+        self.names = list(names)
+        self._state = 'pending'
+        self._filters = OrderedDict((n, 'pending') for n in self.names)
+        self._errors = []
+        self._timings = {}
+        self._created = time()
+        self._finished = None
+        self._callbacks = []
+        self._cond = Condition()
+
+    @property
+    def done(self):
+        return self._state in ('done', 'failed')
+
+    def start(self):
+        """
+        Mark the job as running.
+        """
+        with self._cond:
+            self._state = 'running'
+
+    def progress(self, name, step):
+        """
+        Record the update step reached by a filter.
+
+        :param name: The name of the filter.
+        :param step: The update step.
+        """
+        with self._cond:
+            self._filters[name] = step
+
+    def finish(self, errors, timings):
+        """
+        End the job, wake up its waiters and call its callbacks.
+
+        :param errors: The list of the update errors.
+        :param timings: The update durations of each filter.
+        """
+        with self._cond:
+            self._errors = errors
+            self._timings = timings
+            self._state = 'failed' if errors else 'done'
+            self._finished = time()
+            self._cond.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Call a function when the job ends, immediately if it already ended.
+
+        :param callback: Callable taking the job.
+        """
+        with self._cond:
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout):
+        """
+        Wait for the job to end.
+
+        :param timeout: The maximum time to wait, in seconds.
+        :return: True if the job ended, False otherwise.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.done, timeout)
+
+    def to_dict(self):
+        """
+        :return: A dict describing the state of the job.
+        """
+        with self._cond:
+            job = {
+                'job': self.id,
+                'state': self._state,
+                'filters': dict(self._filters),
+                'created': self._created,
+                'finished': self._finished
+            }
+            if self.done:
+                job['status'] = 'KO' if self._errors else 'OK'
+                job['timings'] = self._timings
+                if self._errors:
+                    job['errors'] = self._errors
+        return job
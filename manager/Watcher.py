@@ -0,0 +1,140 @@
+__author__ = "Vulture Project"
+__credits__ = []
+__license__ = "GPLv3"
+__version__ = "1.0"
+__maintainer__ = "Vulture Project"
+__email__ = "contact@vultureproject.org"
+__doc__ = 'Filesystem events watching class'
+
+import logging
+import os
+import select
+import ctypes
+import ctypes.util
+from time import sleep
+
+logger = logging.getLogger()
+
+# inotify(7) constants, see <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError, TypeError):
+    _inotify_init1 = None
+    _inotify_add_watch = None
+
+
+class DirectoryWatcher:
+    """
+    Wait for entries of a set of directories to be created, modified or deleted.
+
+    Uses inotify on Linux and kqueue on BSD systems.
+    When none is available, waiting falls back to a plain sleep.
+    """
+
+    def __init__(self, directories):
+        """
+        Constructor, start watching the directories.
+
+        :param directories: An iterable of the directories paths to watch.
+        """
+        self._fd = None
+        self._kqueue = None
+        self._kqueue_fds = []
+
+        try:
+            if _inotify_init1 is not None:
+                self._init_inotify(directories)
+            elif hasattr(select, 'kqueue'):
+                self._init_kqueue(directories)
+        except OSError as e:
+            logger.warning("DirectoryWatcher: cannot watch {}, falling back to polling: {}".format(directories, e))
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _init_inotify(self, directories):
+        fd = _inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._fd = fd
+
+        for directory in directories:
+            if _inotify_add_watch(self._fd, os.fsencode(directory), IN_WATCH_MASK) < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno), directory)
+
+    def _init_kqueue(self, directories):
+        self._kqueue = select.kqueue()
+        events = []
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            self._kqueue_fds.append(fd)
+            events.append(select.kevent(
+                fd,
+                filter=select.KQ_FILTER_VNODE,
+                flags=select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                fflags=select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_ATTRIB
+            ))
+        self._kqueue.control(events, 0)
+
+    def wait(self, timeout):
+        """
+        Block until an event occurs in one of the watched directories, or the timeout expires.
+
+        :param timeout: The maximum time to wait, in seconds.
+        :return: True if an event occurred, False otherwise.
+        """
+        timeout = max(timeout, 0)
+
+        if self._fd is not None:
+            # poll, unlike select, handles descriptors above FD_SETSIZE
+            poller = select.poll()
+            poller.register(self._fd, select.POLLIN)
+            if not poller.poll(timeout * 1000):
+                return False
+            # Drain pending events, only their occurrence matters
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            return True
+
+        if self._kqueue is not None:
+            return len(self._kqueue.control(None, 16, timeout)) > 0
+
+        sleep(timeout)
+        return False
+
+    def close(self):
+        """
+        Stop watching and release the associated resources.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._kqueue is not None:
+            self._kqueue.close()
+            self._kqueue = None
+        for fd in self._kqueue_fds:
+            os.close(fd)
+        self._kqueue_fds = []
@@ -8,6 +8,7 @@ __doc__ = 'Everything related to config parsing'
 
 import logging
 import json
+from copy import deepcopy
 from jsonschema import validators, Draft7Validator
 import psutil
 
@@ -156,6 +157,101 @@ conf_v2_schema = {
                     },
                     "default": ["cpu_percent", "memory_percent"],
                     "additionalProperties": False
+                },
+                "metrics": {
+                    "type": "object",
+                    "properties": {
+                        "unix_path": {"type": "string"},
+                        "ip": {"type": "string"},
+                        "port": {
+                            "type": "integer",
+                            "minimum": 1,
+                            "maximum": 65535
+                        },
+                        "max_age_ms": {
+                            "type": "integer",
+                            "minimum": 0,
+                            "default": 1000
+                        }
+                    },
+                    "oneOf": [
+                        {"required": ["unix_path"]},
+                        {"required": ["port"]}
+                    ],
+                    "dependencies": {
+                        "ip": ["port"]
+                    },
+                    "additionalProperties": False
+                }
+            },
+            "additionalProperties": False
+        },
+        "manager": {
+            "type": "object",
+            "properties": {
+                "parallel_start": {
+                    "type": "boolean",
+                    "default": False
+                },
+                "start_workers": {
+                    "type": "integer",
+                    "minimum": 1,
+                    "default": 4
+                },
+                "ready_timeout": {
+                    "type": "number",
+                    "exclusiveMinimum": 0,
+                    "default": 10
+                },
+                "stop_timeout": {
+                    "type": "number",
+                    "exclusiveMinimum": 0,
+                    "default": 10
+                },
+                "supervise": {
+                    "type": "boolean",
+                    "default": False
+                },
+                "drain_timeout": {
+                    "type": "number",
+                    "minimum": 0,
+                    "default": 5
+                },
+                "cgroup_root": {"type": "string"},
+                "startup_traces": {
+                    "type": "integer",
+                    "minimum": 1,
+                    "default": 10
+                },
+                "admin_workers": {
+                    "type": "integer",
+                    "minimum": 1,
+                    "default": 8
+                },
+                "admin_max_sessions": {
+                    "type": "integer",
+                    "minimum": 1,
+                    "default": 64
+                },
+                "admin_idle_timeout": {
+                    "type": "number",
+                    "exclusiveMinimum": 0,
+                    "default": 300
+                },
+                "monitoring_timeout": {
+                    "type": "number",
+                    "exclusiveMinimum": 0,
+                    "default": 1
+                },
+                "history_interval": {
+                    "type": "number",
+                    "minimum": 0,
+                    "default": 10
+                },
+                "history_size": {
+                    "type": "integer",
+                    "minimum": 1,
+                    "default": 2160
                 }
             },
             "additionalProperties": False
@@ -193,6 +289,66 @@ conf_v2_schema = {
                     "threshold": {
                         "type": "integer",
                         "default": 100
+                        },
+                    "standby": {
+                        "type": "boolean",
+                        "default": False
+                        },
+                    "instances": {
+                        "type": "integer",
+                        "minimum": 1,
+                        "maximum": 64,
+                        "default": 1
+                        },
+                    "balancing": {
+                        "type": "string",
+                        "enum": ["round_robin", "least_connections"],
+                        "default": "round_robin"
+                        },
+                    "cpu_affinity": {
+                        "type": "array",
+                        "items": {
+                            "type": "integer",
+                            "minimum": 0
+                        },
+                        "minItems": 1
+                        },
+                    "nice": {
+                        "type": "integer",
+                        "minimum": -20,
+                        "maximum": 19
+                        },
+                    "ionice": {
+                        "type": "object",
+                        "properties": {
+                            "class": {
+                                "type": "string",
+                                "enum": ["none", "realtime", "best_effort", "idle"]
+                            },
+                            "value": {
+                                "type": "integer",
+                                "minimum": 0,
+                                "maximum": 7
+                            }
+                        },
+                        "required": ["class"],
+                        "additionalProperties": False
+                        },
+                    "cpu_max": {
+                        "type": "string",
+                        "pattern": "^(max|[0-9]+)( [0-9]+)?$"
+                        },
+                    "memory_high": {
+                        "oneOf": [
+                            {"type": "integer", "minimum": 0},
+                            {"type": "string", "pattern": "^(max|[0-9]+[KMG]?)$"}
+                        ]
+                        },
+                    "memory_max": {
+                        "oneOf": [
+                            {"type": "integer", "minimum": 0},
+                            {"type": "string", "pattern": "^(max|[0-9]+[KMG]?)$"}
+                        ]
                         }
                 },
                 "required": ["name", "exec_path", "config_file"],
@@ -211,6 +367,7 @@ conf_v2_schema = {
 config_file = ""
 filters = {}
 stats_reporting = {}
+manager_settings = {}
 #########################
 
 class ConfParseError(Exception):
@@ -222,6 +379,7 @@ def load_conf(prefix, suffix, conf=""):
     global config_file
     global stats_reporting
     global filters
+    global manager_settings
     logger.debug("Configurator: Trying to open config file...")
 
     if conf:
@@ -244,6 +402,8 @@ def load_conf(prefix, suffix, conf=""):
         filters.clear()
         stats_reporting.clear()
         stats_reporting.update(configuration['report_stats'])
+        manager_settings.clear()
+        manager_settings.update(configuration.get('manager', {}))
         for filter in configuration['filters']:
             filters[filter['name']] = filter
         logger.debug("Configurator: loaded v2 config successfully")
@@ -254,16 +414,44 @@ def load_conf(prefix, suffix, conf=""):
         except Exception as e:
             raise ConfParseError("Incorrect configuration format: {}".format(e.message))
         stats_reporting.clear()
+        manager_settings.clear()
         filters.clear()
         filters.update(configuration)
         logger.debug("Configurator: loaded v1 config successfully")
 
     complete_filters_conf(prefix, suffix)
 
+def expand_filters_instances(prefix, suffix):
+    """
+    Replace each filter configured with several instances by one filter per instance,
+    named '<name>@<index>'. The socket of the filter is then served by the manager,
+    which balances the connections between the instances.
+    """
+    expanded = {}
+    for name, filter in filters.items():
+        instances = filter.get('instances', 1)
+        if instances <= 1:
+            expanded[name] = filter
+            continue
+
+        for i in range(1, instances + 1):
+            instance = deepcopy(filter)
+            instance['name'] = '{}@{}'.format(name, i)
+            instance['instance_of'] = name
+            instance['balancer_socket'] = '{prefix}/sockets{suffix}/{filter}.sock'.format(prefix=prefix, suffix=suffix, filter=name)
+            expanded[instance['name']] = instance
+
+    filters.clear()
+    filters.update(expanded)
+
 def complete_filters_conf(prefix, suffix):
     for name, filter in filters.items():
         if name and not filter.get('name'):
             filter['name'] = name
+
+    expand_filters_instances(prefix, suffix)
+
+    for name, filter in filters.items():
         filter['status'] = psutil.STATUS_WAKING
         filter['failures'] = 0
         filter['extension'] = '.1'
@@ -91,7 +91,8 @@ namespace darwin {
     }
 
     void Monitor::SendMonitoringData() {
-        std::string message("{\"status\": ");
+        std::string& message = _message;
+        message.assign("{\"status\": ");
         switch(darwin::stats::filter_status) {
             case darwin::stats::FilterStatusEnum::starting : message.append("\"starting\"");   break;
             case darwin::stats::FilterStatusEnum::configuring : message.append("\"configuring\"");    break;
@@ -107,7 +108,13 @@ namespace darwin {
         message.append(std::to_string(STAT_PARSE_ERRORS));
         message.append(", \"matches\":");
         message.append(std::to_string(STAT_MATCHES));
-        message.append("}");
+        message.append(", \"latency\": {\"parse\": ");
+        message.append(STAT_PARSE_LATENCIES.ToJson());
+        message.append(", \"processing\": ");
+        message.append(STAT_PROCESSING_LATENCIES.ToJson());
+        message.append(", \"response_write\": ");
+        message.append(STAT_RESPONSE_WRITE_LATENCIES.ToJson());
+        message.append("}}");
 
         boost::asio::async_write(_connection, boost::asio::buffer(message),
                                  boost::bind(&Monitor::HandleSend, this,
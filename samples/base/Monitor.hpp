@@ -65,5 +65,6 @@ namespace darwin {
         boost::asio::signal_set _signals; //!< Set of the stopping signals.
         boost::asio::local::stream_protocol::acceptor _acceptor; //!< Acceptor for the incoming connections.
         boost::asio::local::stream_protocol::socket _connection; //!< Socket of the current connection.
+        std::string _message; //!< Monitoring data being sent, kept alive until the write completes.
     };
 }
\ No newline at end of file
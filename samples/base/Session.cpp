@@ -15,6 +15,7 @@
 #include "Logger.hpp"
 #include "Manager.hpp"
 #include "Session.hpp"
+#include "Stats.hpp"
 #include "errors.hpp"
 
 #include "../../toolkit/lru_cache.hpp"
@@ -176,7 +177,10 @@ namespace darwin {
                     return;
                 }
 
-                if (!ParseBody()) {
+                auto parse_start = std::chrono::steady_clock::now();
+                bool parsed = ParseBody();
+                STAT_PARSE_LATENCY(std::chrono::steady_clock::now() - parse_start);
+                if (!parsed) {
                     DARWIN_LOG_DEBUG("Session::ReadBodyCallback Something went wrong while parsing the body");
                     this->SendErrorResponse("Error receiving body: Something went wrong while parsing the body", DARWIN_RESPONSE_CODE_REQUEST_ERROR);
                     return;
@@ -194,7 +198,9 @@ namespace darwin {
         DARWIN_LOGGER;
         DARWIN_LOG_DEBUG("Session::ExecuteFilter::");
 
+        auto processing_start = std::chrono::steady_clock::now();
         (*this)();
+        STAT_PROCESSING_LATENCY(std::chrono::steady_clock::now() - processing_start);
         this->SendNext();
     }
 
@@ -287,6 +293,7 @@ namespace darwin {
         memcpy(packet->evt_id, _header.evt_id, 16);
         memcpy((char*)(packet) + sizeof(darwin_filter_packet_t), _response_body.c_str(), _response_body.length());
 
+        _write_starting_time = std::chrono::steady_clock::now();
         boost::asio::async_write(_socket,
                                 boost::asio::buffer(packet, packet_size),
                                 boost::bind(&Session::SendToClientCallback, this,
@@ -398,6 +405,7 @@ namespace darwin {
             return;
         }
 
+        STAT_RESPONSE_WRITE_LATENCY(std::chrono::steady_clock::now() - _write_starting_time);
         Start();
     }
 
@@ -200,6 +200,7 @@ private:
         std::string _next_filter_path; //!< The socket path to the next filter.
         config::output_type _output; //!< The filter's output.
         std::array<char, DARWIN_SESSION_BUFFER_SIZE> _buffer; //!< Reading buffer for the body.
+        std::chrono::steady_clock::time_point _write_starting_time; //!< Start of the write of the response to the client.
 
 
         // Accessible by children
@@ -5,6 +5,7 @@
 /// \license  GPLv3
 /// \brief    Copyright (c) 2018 Advens. All rights reserved.
 
+#include <cstdint>
 #include "Stats.hpp"
 
 namespace darwin {
@@ -16,5 +17,41 @@ namespace darwin {
         std::atomic_uint_fast64_t received;
         std::atomic_uint_fast64_t parseError;
         std::atomic_uint_fast64_t matchCount;
+        LatencyHistogram parseLatency;
+        LatencyHistogram processingLatency;
+        LatencyHistogram responseWriteLatency;
+
+        void LatencyHistogram::Record(std::chrono::nanoseconds const& duration) noexcept {
+            auto us = std::chrono::duration_cast<std::chrono::microseconds>(duration).count();
+            uint64_t value = us > 0 ? static_cast<uint64_t>(us) : 0;
+            // Index of the highest bit set, plus one
+            std::size_t bucket = value ? 64 - __builtin_clzll(value) : 0;
+            if (bucket >= BUCKETS) bucket = BUCKETS - 1;
+
+            _buckets[bucket].fetch_add(1, std::memory_order_relaxed);
+            _sum_us.fetch_add(value, std::memory_order_relaxed);
+            _count.fetch_add(1, std::memory_order_relaxed);
+        }
+
+        std::string LatencyHistogram::ToJson() const {
+            std::array<uint_fast64_t, BUCKETS> buckets;
+            std::size_t used = 0;
+            for (std::size_t i = 0; i < BUCKETS; ++i) {
+                buckets[i] = _buckets[i].load(std::memory_order_relaxed);
+                if (buckets[i]) used = i + 1;
+            }
+
+            std::string json("{\"count\": ");
+            json.append(std::to_string(_count.load(std::memory_order_relaxed)));
+            json.append(", \"sum_us\": ");
+            json.append(std::to_string(_sum_us.load(std::memory_order_relaxed)));
+            json.append(", \"buckets\": [");
+            for (std::size_t i = 0; i < used; ++i) {
+                if (i) json.append(", ");
+                json.append(std::to_string(buckets[i]));
+            }
+            json.append("]}");
+            return json;
+        }
     }
 }
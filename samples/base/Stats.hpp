@@ -7,7 +7,9 @@
 
 #pragma once
 
+#include <array>
 #include <atomic>
+#include <chrono>
 #include <string>
 
 namespace darwin {
@@ -15,11 +17,39 @@ namespace darwin {
     namespace stats {
         enum class FilterStatusEnum {starting, configuring, running, stopping};
 
+        /// Lock-free histogram of durations, with logarithmic buckets:
+        /// bucket 0 counts the durations under 1 microsecond,
+        /// and bucket i the durations in [2^(i-1), 2^i[ microseconds, the last one being unbounded.
+        class LatencyHistogram {
+        public:
+            static constexpr std::size_t BUCKETS = 32;
+
+            /// Count a duration.
+            ///
+            /// \param duration The duration to count.
+            void Record(std::chrono::nanoseconds const& duration) noexcept;
+
+            /// Get the JSON representation of the histogram:
+            /// {"count": <count>, "sum_us": <sum of the durations>, "buckets": [<count of each bucket>]},
+            /// the trailing empty buckets being omitted.
+            ///
+            /// \return The JSON string.
+            std::string ToJson() const;
+
+        private:
+            std::array<std::atomic_uint_fast64_t, BUCKETS> _buckets{};
+            std::atomic_uint_fast64_t _count{0};
+            std::atomic_uint_fast64_t _sum_us{0};
+        };
+
         extern std::atomic<FilterStatusEnum> filter_status;
         extern std::atomic_uint_fast64_t clientsNum;
         extern std::atomic_uint_fast64_t received;
         extern std::atomic_uint_fast64_t parseError;
         extern std::atomic_uint_fast64_t matchCount;
+        extern LatencyHistogram parseLatency;
+        extern LatencyHistogram processingLatency;
+        extern LatencyHistogram responseWriteLatency;
     }
 }
 
@@ -29,9 +59,15 @@ namespace darwin {
 #define STAT_INPUT_INC darwin::stats::received++
 #define STAT_PARSE_ERROR_INC darwin::stats::parseError++
 #define STAT_MATCH_INC darwin::stats::matchCount++
+#define STAT_PARSE_LATENCY(duration) darwin::stats::parseLatency.Record(duration)
+#define STAT_PROCESSING_LATENCY(duration) darwin::stats::processingLatency.Record(duration)
+#define STAT_RESPONSE_WRITE_LATENCY(duration) darwin::stats::responseWriteLatency.Record(duration)
 
 #define STAT_FILTER_STATUS darwin::stats::filter_status
 #define STAT_CLIENTS_NUM darwin::stats::clientsNum
 #define STAT_INPUTS darwin::stats::received
 #define STAT_PARSE_ERRORS darwin::stats::parseError
 #define STAT_MATCHES darwin::stats::matchCount
+#define STAT_PARSE_LATENCIES darwin::stats::parseLatency
+#define STAT_PROCESSING_LATENCIES darwin::stats::processingLatency
+#define STAT_RESPONSE_WRITE_LATENCIES darwin::stats::responseWriteLatency
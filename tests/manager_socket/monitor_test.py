@@ -1,16 +1,43 @@
-from manager_socket.utils import requests, CONF_EMPTY, CONF_FTEST, CONF_ONE, CONF_ONE_V2, CONF_THREE, CONF_THREE_V2, CONF_THREE_ONE_WRONG, CONF_THREE_ONE_WRONG_V2, REQ_MONITOR, RESP_EMPTY, RESP_TEST_1, RESP_TEST_2, RESP_TEST_3, PATH_CONF_FTEST
+from manager_socket.utils import requests, wait_for, read_pid_file, process_running, filter_requests, chunked_requests, session_requests, subscribe, CONF_EMPTY, CONF_FTEST, CONF_ONE, CONF_ONE_V2, CONF_ONE_V2_STANDBY, CONF_ONE_V2_STANDBY_SUPERVISED, CONF_ONE_V2_SUPERVISED, CONF_ONE_V2_INSTANCES, CONF_THREE, CONF_THREE_V2, CONF_THREE_V2_PARALLEL, CONF_THREE_ONE_WRONG, CONF_THREE_ONE_WRONG_V2, REQ_MONITOR, REQ_MONITOR_FRAMED, REQ_NOT_OBJECT_FRAMED, REQ_MONITOR_CHUNKS, REQ_MONITOR_SELECT, REQ_MONITOR_RATES, REQ_MONITOR_LATENCY, REQ_HISTORY, REQ_SUBSCRIBE, REQ_MONITOR_MAX_AGE, REQ_MONITOR_ID_1, REQ_MONITOR_ID_2, REQ_STARTUP_TRACES, RESP_EMPTY, RESP_NOT_OBJECT, RESP_TEST_1, RESP_TEST_2, RESP_TEST_3, RESP_TEST_1_TIMEOUT, RESP_TEST_2_TIMEOUT, MONITORING_TIMEOUT, RESP_TEST_1_RESTARTED, RESTART_TIMEOUT, RESP_STANDBY_READY, RESP_STANDBY_UNAVAILABLE, STANDBY_READY_TIMEOUT, RESP_TEST_1_INSTANCES, RESP_STARTUP_TRACE_TEST_1, RESP_LATENCY_TEST_1, PATH_CONF_FTEST
 from tools.darwin_utils import darwin_configure, darwin_remove_configuration, darwin_start, darwin_stop
 from tools.output import print_result
+from conf import DEFAULT_MANAGER_PATH, FILTER_PIDS_DIR
+from time import sleep, time
+from signal import SIGKILL, SIGSTOP, SIGCONT
+import json
+import logging
+import os
+import sys
 
 
 def run():
     tests = [
         multiple_filters_running,
         multiple_filters_running_conf_v2,
+        multiple_filters_monitoring_timeout_conf_v2,
+        multiple_filters_running_parallel_start_conf_v2,
 		multiple_filters_running_one_fail,
 		multiple_filters_running_one_fail_conf_v2,
         one_filters_running,
         one_filters_running_conf_v2,
+        one_filter_running_standby_conf_v2,
+        one_filter_standby_stop_without_pid_files,
+        one_filter_supervised_standby_crash,
+        one_filter_supervised_restart,
+        one_filter_multiple_instances_conf_v2,
+        one_filter_startup_traces,
+        one_filter_framed_request,
+        not_object_framed_request,
+        one_filter_chunked_request,
+        one_filter_cached_monitoring,
+        multiple_filters_selected_monitoring_conf_v2,
+        one_filter_monitoring_rates,
+        one_filter_history,
+        one_filter_latency,
+        one_filter_latency_traffic,
+        latency_histogram_percentiles,
+        one_filter_pipelined_requests,
+        one_filter_subscribe,
         no_filter,
     ]
 
@@ -52,6 +79,57 @@ def multiple_filters_running_conf_v2():
     darwin_remove_configuration(path=PATH_CONF_FTEST)
     return ret
 
+def multiple_filters_monitoring_timeout_conf_v2():
+
+    ret = False
+
+    darwin_configure(CONF_THREE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    # Stopped filters accept the monitoring connections, but never answer
+    pids = [read_pid_file(FILTER_PIDS_DIR + name + ".1.pid") for name in ["test_1", "test_2"]]
+    if all(pids):
+        for pid in pids:
+            os.kill(pid, SIGSTOP)
+
+        begin = time()
+        resp = requests(REQ_MONITOR)
+        elapsed = time() - begin
+
+        for pid in pids:
+            os.kill(pid, SIGCONT)
+
+        # The filters share the same deadline, instead of being waited for one after the other
+        if not all(x in resp for x in [RESP_TEST_1_TIMEOUT, RESP_TEST_2_TIMEOUT, RESP_TEST_3]):
+            logging.error("multiple_filters_monitoring_timeout: Mismatching monitor response; got \"{}\"".format(resp))
+        elif not MONITORING_TIMEOUT <= elapsed < 2 * MONITORING_TIMEOUT:
+            logging.error("multiple_filters_monitoring_timeout: monitor answered in {}s".format(elapsed))
+        else:
+            ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def multiple_filters_running_parallel_start_conf_v2():
+
+    ret = False
+
+    darwin_configure(CONF_THREE_V2_PARALLEL)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    resp = requests(REQ_MONITOR)
+    if all(x in resp for x in [RESP_TEST_1, RESP_TEST_2, RESP_TEST_3]):
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
 def multiple_filters_running_one_fail():
 
     ret = False
@@ -121,6 +199,360 @@ def one_filters_running_conf_v2():
     darwin_remove_configuration(path=PATH_CONF_FTEST)
     return ret
 
+def one_filter_running_standby_conf_v2():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2_STANDBY)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    # The standby instance is spawned in the background once the filter is running
+    if wait_for(lambda: RESP_STANDBY_READY in requests(REQ_MONITOR), STANDBY_READY_TIMEOUT):
+        ret = RESP_TEST_1 in requests(REQ_MONITOR)
+    else:
+        logging.error("one_filter_running_standby_conf_v2: standby instance not ready")
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_standby_stop_without_pid_files():
+
+    ret = False
+    pids = []
+
+    darwin_configure(CONF_ONE_V2_STANDBY)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    if wait_for(lambda: RESP_STANDBY_READY in requests(REQ_MONITOR), STANDBY_READY_TIMEOUT):
+        # The filter and its standby instance must be stopped by their own pid, without their pid files
+        for extension in [".1", ".2"]:
+            pids.append(read_pid_file(FILTER_PIDS_DIR + "test_1" + extension + ".pid"))
+            os.remove(FILTER_PIDS_DIR + "test_1" + extension + ".pid")
+    else:
+        logging.error("one_filter_standby_stop_without_pid_files: standby instance not ready")
+
+    darwin_stop(process)
+
+    if pids and all(pids):
+        ret = wait_for(lambda: not any(process_running(pid) for pid in pids), 5)
+        if not ret:
+            logging.error("one_filter_standby_stop_without_pid_files: filter processes still running: {}".format(
+                [pid for pid in pids if process_running(pid)]))
+            for pid in pids:
+                if process_running(pid):
+                    os.kill(pid, SIGKILL)
+
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_supervised_restart():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2_SUPERVISED)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    pid = read_pid_file(FILTER_PIDS_DIR + "test_1.1.pid")
+    if pid and RESP_TEST_1 in requests(REQ_MONITOR):
+        os.kill(pid, SIGKILL)
+        # The supervisor is notified of the exit, and reaps the process re-parented to the manager
+        if not wait_for(lambda: RESP_TEST_1_RESTARTED in requests(REQ_MONITOR), RESTART_TIMEOUT):
+            logging.error("one_filter_supervised_restart: filter not restarted")
+        elif process_running(pid):
+            logging.error("one_filter_supervised_restart: killed filter process {} not reaped".format(pid))
+        else:
+            ret = read_pid_file(FILTER_PIDS_DIR + "test_1.1.pid") not in [None, pid]
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_supervised_standby_crash():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2_STANDBY_SUPERVISED)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    if wait_for(lambda: RESP_STANDBY_READY in requests(REQ_MONITOR), STANDBY_READY_TIMEOUT):
+        # The supervised standby instance is a child of the manager: once killed, it must not be reported ready
+        pid = read_pid_file(FILTER_PIDS_DIR + "test_1.2.pid")
+        if pid:
+            os.kill(pid, SIGKILL)
+            ret = wait_for(lambda: RESP_STANDBY_UNAVAILABLE in requests(REQ_MONITOR), 5)
+            if not ret:
+                logging.error("one_filter_supervised_standby_crash: crashed standby instance still reported ready")
+    else:
+        logging.error("one_filter_supervised_standby_crash: standby instance not ready")
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_multiple_instances_conf_v2():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2_INSTANCES)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    resp = requests(REQ_MONITOR)
+    if RESP_TEST_1_INSTANCES in resp and '"test_1@2"' in resp:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_startup_traces():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    resp = requests(REQ_STARTUP_TRACES)
+    if resp.startswith(RESP_STARTUP_TRACE_TEST_1) and all('"{}": '.format(phase) in resp for phase in ['spawn', 'daemonized', 'pid_file', 'monitoring_socket', 'running', 'main_socket']):
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_framed_request():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    resp = requests(REQ_MONITOR_FRAMED)
+    header, _, payload = resp.partition('\n')
+    if header.startswith('#') and int(header[1:]) == len(payload) and RESP_TEST_1 in payload:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def not_object_framed_request():
+
+    ret = False
+
+    darwin_configure(CONF_EMPTY)
+    process = darwin_start()
+
+    resp = requests(REQ_NOT_OBJECT_FRAMED)
+    if RESP_NOT_OBJECT in resp:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    return ret
+
+def one_filter_chunked_request():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    resp = chunked_requests(REQ_MONITOR_CHUNKS)
+    if RESP_TEST_1 in resp:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_cached_monitoring():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    first = requests(REQ_MONITOR_MAX_AGE)
+    second = requests(REQ_MONITOR_MAX_AGE)
+    # The second request is answered from the snapshot collected for the first one
+    if RESP_TEST_1 in first and first == second:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def multiple_filters_selected_monitoring_conf_v2():
+
+    ret = False
+
+    darwin_configure(CONF_THREE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    resp = requests(REQ_MONITOR_SELECT)
+    if resp == '{"test_2": {"status": "running", "received": 0}}':
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_monitoring_rates():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    # The rates are derived from the counters of two collections
+    requests(REQ_MONITOR_RATES)
+    sleep(1.5)
+    resp = requests(REQ_MONITOR_RATES)
+    if '"rates": {"events_per_s": 0.0,' in resp and '"match_ratio": null' in resp:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_history():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    # The history is sampled when the manager starts
+    resp = requests(REQ_HISTORY)
+    if resp.startswith('{"test_1": {"time": [') and '"metrics": {"received": {"min": [0.0], "max": [0.0], "avg": [0.0]}}' in resp:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_latency():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    resp = requests(REQ_MONITOR_LATENCY)
+    if resp == RESP_LATENCY_TEST_1:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_latency_traffic():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    if filter_requests("test_1", ["hello"] * 20) == 20:
+        try:
+            latency = json.loads(requests(REQ_MONITOR_LATENCY))['test_1']['latency']
+            ret = all(latency[stage]['count'] > 0 and
+                      latency[stage]['p50_ms'] is not None and
+                      latency[stage]['p50_ms'] <= latency[stage]['p95_ms'] <= latency[stage]['p99_ms']
+                      for stage in ['parse', 'processing', 'response_write'])
+        except Exception as e:
+            logging.error("one_filter_latency_traffic: unexpected monitoring response: {}".format(e))
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def latency_histogram_percentiles():
+
+    sys.path.insert(0, os.path.dirname(DEFAULT_MANAGER_PATH))
+    from LatencyHistogram import LatencyHistogram
+
+    # 50 durations in [1, 2[ us, 45 in [2, 4[ us and 5 in [512, 1024[ us
+    histogram = {'count': 100, 'sum_us': 0, 'buckets': [0, 50, 45, 0, 0, 0, 0, 0, 0, 0, 5]}
+    expected = {0.5: 0.002, 0.95: 0.004, 0.99: 0.9216}
+    if any(abs(LatencyHistogram.percentile(histogram, q) - v) > 1e-9 for q, v in expected.items()):
+        return False
+    if LatencyHistogram.percentile({'count': 0, 'sum_us': 0, 'buckets': []}, 0.5) is not None:
+        return False
+
+    merged = LatencyHistogram.merge([
+        {'parse': {'count': 1, 'sum_us': 3, 'buckets': [0, 0, 1]}},
+        {'parse': {'count': 2, 'sum_us': 2, 'buckets': [0, 2]}, 'processing': {'count': 1, 'sum_us': 0, 'buckets': [1]}}
+    ])
+    return merged == {
+        'parse': {'count': 3, 'sum_us': 5, 'buckets': [0, 2, 1]},
+        'processing': {'count': 1, 'sum_us': 0, 'buckets': [1]}
+    }
+
+def one_filter_pipelined_requests():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    replies = session_requests([REQ_MONITOR_ID_1, REQ_MONITOR_ID_2])
+    if sorted(r.get('id') for r in replies) == [1, 2] and all(r['response']['test_1']['status'] == 'running' for r in replies):
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_filter_subscribe():
+
+    ret = False
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    lines = subscribe(REQ_SUBSCRIBE, 2)
+    if len(lines) == 2 and lines[0].get('status') == 'OK' and \
+            lines[1].get('delta') == {'test_1': {'status': 'running', 'received': 0}}:
+        ret = True
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
 def no_filter():
     ret = False
 
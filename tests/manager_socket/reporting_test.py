@@ -6,6 +6,7 @@ from time import sleep
 from tools.redis_utils import RedisServer
 import os
 import stat
+import socket
 
 from manager_socket.utils import requests, PATH_CONF_FTEST, CONF_ONE, CONF_FTEST, REQ_MONITOR, REQ_MONITOR_CUSTOM_STATS, REQ_MONITOR_ERROR
 from tools.darwin_utils import darwin_configure, darwin_remove_configuration, darwin_start, darwin_stop
@@ -37,6 +38,8 @@ DEFAULT_REDIS_SOCKET = "/tmp/darwin_test_redis.sock"
 DEFAULT_REDIS_CHANNEL = "darwin.tests"
 DEFAULT_REDIS_LIST = "darwin_tests"
 DEFAULT_STATS_FILE = "/tmp/darwin_stats_test.log"
+DEFAULT_METRICS_SOCKET = "/tmp/darwin_metrics_test.sock"
+METRICS_MATCH = 'darwin_filter_received_total{filter="test_1"} 0'
 STAT_LOG_MATCH = '{"test_1": {"status": "running", "connections": 0, "received": 0, "entryErrors": 0, "matches": 0, "failures": 0, "proc_stats": {"'
 
 
@@ -49,6 +52,7 @@ def run():
         redis_reports,
         file_reports,
         file_and_redis_simple_report,
+        metrics_endpoint,
     ]
 
     for i in tests:
@@ -376,4 +380,38 @@ def file_and_redis_simple_report():
     darwin_remove_configuration()
     darwin_remove_configuration(path=PATH_CONF_FTEST)
 
-    return ret
\ No newline at end of file
+    return ret
+
+def metrics_endpoint():
+    ret = False
+
+    darwin_configure(CONF_TEMPLATE.substitute(log_path=DEFAULT_FILTER_PATH, conf_path=PATH_CONF_FTEST,
+        conf_redis="", conf_file="\"metrics\": {{\"unix_path\": \"{}\"}},".format(DEFAULT_METRICS_SOCKET), proc_stats=""))
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    try:
+        sock.connect(DEFAULT_METRICS_SOCKET)
+        sock.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        response = response.decode()
+        if response.startswith("HTTP/1.0 200") and METRICS_MATCH in response and response.endswith("# EOF\n"):
+            ret = True
+        else:
+            logging.error("metrics_endpoint(): not expected result -> {}".format(response))
+    except Exception as e:
+        logging.error("metrics_endpoint(): error scraping metrics -> {}".format(e))
+    finally:
+        sock.close()
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
@@ -1,6 +1,7 @@
 import logging
+import json
 from time import sleep
-from manager_socket.utils import requests, check_filter_files, PATH_CONF_FTEST, CONF_EMPTY, CONF_ONE, CONF_ONE_V2, CONF_THREE, CONF_THREE_V2, CONF_THREE_V2_ALT, CONF_TWO_V2, CONF_FOUR_V2, CONF_FTEST, CONF_FTEST_WRONG_CONF, REQ_MONITOR, REQ_UPDATE_EMPTY, REQ_UPDATE_ONE, REQ_UPDATE_TWO, REQ_UPDATE_THREE, REQ_UPDATE_NON_EXISTING, REQ_UPDATE_NO_FILTER, RESP_EMPTY, RESP_TEST_1, RESP_TEST_2, RESP_TEST_3, RESP_TEST_4, RESP_STATUS_OK, RESP_STATUS_KO, RESP_ERROR_FILTER_NOT_EXISTING
+from manager_socket.utils import requests, filter_connection, check_filter_files, PATH_CONF_FTEST, CONF_EMPTY, CONF_ONE, CONF_ONE_V2, CONF_ONE_V2_DRAIN, DRAIN_TIMEOUT, CONF_THREE, CONF_THREE_V2, CONF_THREE_V2_ALT, CONF_TWO_V2, CONF_FOUR_V2, CONF_FTEST, CONF_FTEST_WRONG_CONF, REQ_MONITOR, REQ_UPDATE_EMPTY, REQ_UPDATE_ONE, REQ_UPDATE_TWO, REQ_UPDATE_THREE, REQ_UPDATE_NON_EXISTING, REQ_UPDATE_NO_FILTER, REQ_UPDATE_ONE_ASYNC, REQ_JOB_WAIT, RESP_EMPTY, RESP_TEST_1, RESP_TEST_2, RESP_TEST_3, RESP_TEST_4, RESP_STATUS_OK, RESP_STATUS_KO, RESP_ERROR_FILTER_NOT_EXISTING
 from tools.darwin_utils import darwin_configure, darwin_remove_configuration, darwin_start, darwin_stop
 from tools.output import print_result
 
@@ -22,6 +23,8 @@ def run():
         one_update_none_conf_v2,
         one_update_one,
         one_update_one_conf_v2,
+        one_update_one_async_conf_v2,
+        one_update_one_drain_conf_v2,
         one_update_one_wrong_conf,
         one_update_one_wrong_conf_conf_v2,
         many_update_none,
@@ -496,6 +499,82 @@ def one_update_one_conf_v2():
     return ret
 
 
+def one_update_one_async_conf_v2():
+
+    ret = True
+
+    darwin_configure(CONF_ONE_V2)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    resp = requests(REQ_MONITOR)
+    if RESP_TEST_1 not in resp:
+        logging.error("one_update_one_async: Mismatching monitor response; got \"{}\"".format(resp))
+        ret = False
+
+    sleep(2) # Need this because of the starting delay
+    resp = requests(REQ_UPDATE_ONE_ASYNC)
+    if RESP_STATUS_OK not in resp:
+        logging.error("one_update_one_async: Update response error; got \"{}\"".format(resp))
+        ret = False
+    else:
+        job = json.loads(resp)['job']
+        resp = requests(REQ_JOB_WAIT.format(job).encode())
+        try:
+            status = json.loads(resp)
+            if status['state'] != 'done' or status['filters'].get('test_1') != 'drained':
+                logging.error("one_update_one_async: Unexpected job status; got \"{}\"".format(resp))
+                ret = False
+        except Exception as e:
+            logging.error("one_update_one_async: Job wait response error {}; got \"{}\"".format(e, resp))
+            ret = False
+
+    resp = requests(REQ_MONITOR)
+    if RESP_TEST_1 not in resp:
+        logging.error("one_update_one_async: Mismatching monitor response; got \"{}\"".format(resp))
+        ret = False
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+def one_update_one_drain_conf_v2():
+
+    ret = True
+
+    darwin_configure(CONF_ONE_V2_DRAIN)
+    darwin_configure(CONF_FTEST, path=PATH_CONF_FTEST)
+    process = darwin_start()
+
+    # Keep a client connected to the old instance during the update
+    api = filter_connection("test_1")
+    if api is None:
+        ret = False
+    else:
+        resp = requests(REQ_UPDATE_ONE)
+        try:
+            drain = json.loads(resp)['timings']['test_1']['drain']
+            # The old instance is drained until the timeout, plus the time of the last probe
+            if not 0 < drain <= DRAIN_TIMEOUT + 0.5:
+                logging.error("one_update_one_drain: Unexpected drain time; got \"{}\"".format(resp))
+                ret = False
+        except Exception as e:
+            logging.error("one_update_one_drain: Update response error {}; got \"{}\"".format(e, resp))
+            ret = False
+        api.close()
+
+    resp = requests(REQ_MONITOR)
+    if RESP_TEST_1 not in resp:
+        logging.error("one_update_one_drain: Mismatching monitor response; got \"{}\"".format(resp))
+        ret = False
+
+    darwin_stop(process)
+    darwin_remove_configuration()
+    darwin_remove_configuration(path=PATH_CONF_FTEST)
+    return ret
+
+
 def one_update_one_wrong_conf():
 
     ret = True
@@ -3,9 +3,11 @@ import os
 import socket
 import subprocess
 import logging
-from time import sleep
+import json
+from time import sleep, time
 from conf import MANAGEMENT_SOCKET_PATH, DEFAULT_FILTER_PATH, FILTER_SOCKETS_DIR, FILTER_PIDS_DIR
 from os import access, F_OK
+from darwin import DarwinApi
 
 
 def requests(request):
@@ -31,6 +33,146 @@ def requests(request):
 
     return response
 
+def filter_requests(filter_name, lines):
+    """
+    Send each line to a filter managed by the manager, as a separate request waiting for the response.
+    Returns the number of responses received.
+    """
+    responses = 0
+    try:
+        api = DarwinApi(socket_type="unix", socket_path=FILTER_SOCKETS_DIR + filter_name + ".sock")
+        for line in lines:
+            if api.call([line], response_type="back") is not None:
+                responses += 1
+        api.close()
+    except Exception as e:
+        logging.error("manager_socket.utils.filter_requests: " + str(e))
+
+    return responses
+
+def filter_connection(filter_name):
+    """
+    Open a connection to a filter managed by the manager, sending a first request through it.
+    Returns the DarwinApi object to close, None on error.
+    """
+    try:
+        api = DarwinApi(socket_type="unix", socket_path=FILTER_SOCKETS_DIR + filter_name + ".sock")
+        api.call(["hello"], response_type="back")
+        return api
+    except Exception as e:
+        logging.error("manager_socket.utils.filter_connection: " + str(e))
+        return None
+
+def chunked_requests(chunks, delay=0.1):
+    """
+    Send a request split in several chunks, waiting between them, and return the response.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10)
+
+    try:
+        sock.connect(MANAGEMENT_SOCKET_PATH)
+        for chunk in chunks:
+            sock.sendall(chunk)
+            sleep(delay)
+        response = sock.recv(4096).decode()
+    except Exception as e:
+        logging.error("manager_socket.utils.chunked_requests: " + str(e))
+        return ""
+    finally:
+        sock.close()
+
+    return response
+
+def session_requests(requests_list):
+    """
+    Send all the requests on a single admin connection, then wait for one reply per request.
+    Returns the list of the decoded replies, in their order of arrival.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10)
+    replies = []
+
+    try:
+        sock.connect(MANAGEMENT_SOCKET_PATH)
+        sock.sendall(b''.join(requests_list))
+        data = ''
+        decoder = json.JSONDecoder()
+        while len(replies) < len(requests_list):
+            chunk = sock.recv(4096).decode()
+            if not chunk:
+                break
+            data += chunk
+            while data:
+                try:
+                    reply, end = decoder.raw_decode(data)
+                except ValueError:
+                    break
+                replies.append(reply)
+                data = data[end:].lstrip()
+    except Exception as e:
+        logging.error("manager_socket.utils.session_requests: " + str(e))
+    finally:
+        sock.close()
+
+    return replies
+
+def subscribe(request, count):
+    """
+    Send a subscribe request and read the acknowledgement and the first stream messages.
+    Returns the list of the decoded lines.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(10)
+    lines = []
+
+    try:
+        sock.connect(MANAGEMENT_SOCKET_PATH)
+        sock.sendall(request)
+        stream = sock.makefile('rb')
+        while len(lines) < count:
+            line = stream.readline()
+            if not line:
+                break
+            lines.append(json.loads(line.decode()))
+    except Exception as e:
+        logging.error("manager_socket.utils.subscribe: " + str(e))
+    finally:
+        sock.close()
+
+    return lines
+
+def wait_for(condition, timeout, delay=0.2):
+    """
+    Wait until condition() is true, for at most timeout seconds.
+    Returns True if the condition was met in time.
+    """
+    deadline = time() + timeout
+    while not condition():
+        if time() >= deadline:
+            return False
+        sleep(delay)
+    return True
+
+def read_pid_file(file):
+
+    try:
+        with open(file) as f:
+            return int(f.readline())
+    except Exception as e:
+        logging.error("manager_socket.utils.read_pid_file: could not read pid file {}: {}".format(file, e))
+        return None
+
+def process_running(pid):
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 def check_pid_file(file):
     try:
         with open(file, 'r') as f:
@@ -84,6 +226,9 @@ PATH_CONF_FTEST = "/tmp/test.conf"
 
 # Configurations
 
+# Time given to the clients of an updated filter to close their connections, in seconds
+DRAIN_TIMEOUT = 2
+
 CONF_EMPTY = '{}'
 CONF_ONE = """{{
   "test_1": {{
@@ -120,6 +265,133 @@ CONF_ONE_V2 = """{{
     }}
 }}
 """.format(DEFAULT_FILTER_PATH, PATH_CONF_FTEST)
+CONF_ONE_V2_STANDBY = """{{
+    "version": 2,
+    "filters": [
+        {{
+            "name": "test_1",
+            "exec_path": "{0}darwin_test",
+            "config_file": "{1}",
+            "output": "NONE",
+            "next_filter": "",
+            "nb_thread": 1,
+            "log_level": "DEBUG",
+            "cache_size": 0,
+            "standby": true
+        }}
+    ],
+    "report_stats": {{
+        "file": {{
+            "filepath": "/tmp/darwin-stats",
+            "permissions": 640
+        }},
+        "interval": 5
+    }}
+}}
+""".format(DEFAULT_FILTER_PATH, PATH_CONF_FTEST)
+CONF_ONE_V2_DRAIN = """{{
+    "version": 2,
+    "filters": [
+        {{
+            "name": "test_1",
+            "exec_path": "{0}darwin_test",
+            "config_file": "{1}",
+            "output": "NONE",
+            "next_filter": "",
+            "nb_thread": 1,
+            "log_level": "DEBUG",
+            "cache_size": 0
+        }}
+    ],
+    "manager": {{
+        "drain_timeout": {2}
+    }},
+    "report_stats": {{
+        "file": {{
+            "filepath": "/tmp/darwin-stats",
+            "permissions": 640
+        }},
+        "interval": 5
+    }}
+}}
+""".format(DEFAULT_FILTER_PATH, PATH_CONF_FTEST, DRAIN_TIMEOUT)
+CONF_ONE_V2_SUPERVISED = """{{
+    "version": 2,
+    "filters": [
+        {{
+            "name": "test_1",
+            "exec_path": "{0}darwin_test",
+            "config_file": "{1}",
+            "output": "NONE",
+            "next_filter": "",
+            "nb_thread": 1,
+            "log_level": "DEBUG",
+            "cache_size": 0
+        }}
+    ],
+    "manager": {{
+        "supervise": true
+    }},
+    "report_stats": {{
+        "file": {{
+            "filepath": "/tmp/darwin-stats",
+            "permissions": 640
+        }},
+        "interval": 5
+    }}
+}}
+""".format(DEFAULT_FILTER_PATH, PATH_CONF_FTEST)
+CONF_ONE_V2_STANDBY_SUPERVISED = """{{
+    "version": 2,
+    "filters": [
+        {{
+            "name": "test_1",
+            "exec_path": "{0}darwin_test",
+            "config_file": "{1}",
+            "output": "NONE",
+            "next_filter": "",
+            "nb_thread": 1,
+            "log_level": "DEBUG",
+            "cache_size": 0,
+            "standby": true
+        }}
+    ],
+    "manager": {{
+        "supervise": true
+    }},
+    "report_stats": {{
+        "file": {{
+            "filepath": "/tmp/darwin-stats",
+            "permissions": 640
+        }},
+        "interval": 5
+    }}
+}}
+""".format(DEFAULT_FILTER_PATH, PATH_CONF_FTEST)
+CONF_ONE_V2_INSTANCES = """{{
+    "version": 2,
+    "filters": [
+        {{
+            "name": "test_1",
+            "exec_path": "{0}darwin_test",
+            "config_file": "{1}",
+            "output": "NONE",
+            "next_filter": "",
+            "nb_thread": 1,
+            "log_level": "DEBUG",
+            "cache_size": 0,
+            "instances": 2
+        }}
+    ],
+    "report_stats": {{
+        "file": {{
+            "filepath": "/tmp/darwin-stats",
+            "permissions": 640
+        }},
+        "interval": 5
+    }}
+}}
+""".format(DEFAULT_FILTER_PATH, PATH_CONF_FTEST)
 CONF_THREE = """{{
   "test_1": {{
         "exec_path": "{0}darwin_test",
@@ -193,6 +465,53 @@ CONF_THREE_V2 = """{{
     }}
 }}
 """.format(DEFAULT_FILTER_PATH, PATH_CONF_FTEST)
+CONF_THREE_V2_PARALLEL = """{{
+    "version": 2,
+    "filters": [
+    {{
+        "name": "test_1",
+        "exec_path": "{0}darwin_test",
+        "config_file": "{1}",
+        "output": "NONE",
+        "next_filter": "test_2",
+        "nb_thread": 1,
+        "log_level": "DEBUG",
+        "cache_size": 0
+    }},
+    {{
+        "name": "test_2",
+        "exec_path": "{0}darwin_test",
+        "config_file": "{1}",
+        "output": "NONE",
+        "next_filter": "",
+        "nb_thread": 1,
+        "log_level": "DEBUG",
+        "cache_size": 0
+    }},
+    {{
+        "name": "test_3",
+        "exec_path": "{0}darwin_test",
+        "config_file": "{1}",
+        "output": "NONE",
+        "next_filter": "",
+        "nb_thread": 1,
+        "log_level": "DEBUG",
+        "cache_size": 0
+    }}
+    ],
+    "manager": {{
+        "parallel_start": true,
+        "start_workers": 2
+    }},
+    "report_stats": {{
+        "file": {{
+            "filepath": "/tmp/darwin-stats",
+            "permissions": 640
+        }},
+        "interval": 5
+    }}
+}}
+""".format(DEFAULT_FILTER_PATH, PATH_CONF_FTEST)
 CONF_THREE_V2_ALT = """{{
     "version": 2,
     "filters": [
@@ -406,6 +725,19 @@ CONF_FTEST_WRONG_CONF = """{
 # Requests
 
 REQ_MONITOR      = b'{"type": "monitor"}'
+REQ_MONITOR_ID_1 = b'{"id": 1, "type": "monitor"}'
+REQ_MONITOR_ID_2 = b'{"id": 2, "type": "monitor"}'
+REQ_MONITOR_MAX_AGE = b'{"type": "monitor", "max_age_ms": 60000}'
+REQ_SUBSCRIBE = b'{"type": "subscribe", "interval": 0.5, "filters": ["test_1"], "fields": ["status", "received"]}'
+REQ_MONITOR_SELECT = b'{"type": "monitor", "filters": ["test_2"], "fields": ["status", "received"]}'
+REQ_MONITOR_RATES = b'{"type": "monitor", "fields": ["received", "rates"]}'
+REQ_HISTORY = b'{"type": "history", "filters": ["test_1"], "metrics": ["received"], "step": 3600}'
+REQ_MONITOR_LATENCY = b'{"type": "monitor", "fields": ["latency"]}'
+# A monitor request split inside an escape sequence, a number and a literal
+REQ_MONITOR_CHUNKS = [b'{"type": "\\u00', b'6donitor", "max_age_ms": 1', b'0, "filters": nu', b'll}']
+REQ_MONITOR_FRAMED = b'#19\n{"type": "monitor"}'
+REQ_NOT_OBJECT_FRAMED = b'#6\n[1, 2]'
+RESP_NOT_OBJECT = '{"status": "KO", "errors": ["Invalid command: expected a JSON object"]}'
 REQ_MONITOR_CUSTOM_STATS = b'{"type": "monitor", "proc_stats": ["name", "pid", "memory_percent"]}'
 REQ_MONITOR_ERROR = b'{"type": "monitor", "proc_stats": ["foo", "bar"]}'
 REQ_UPDATE_EMPTY = b'{"type": "update_filters", "filters": []}'
@@ -414,6 +746,9 @@ REQ_UPDATE_TWO   = b'{"type": "update_filters", "filters": ["test_2", "test_3"]}
 REQ_UPDATE_THREE = b'{"type": "update_filters", "filters": ["test_1", "test_2", "test_3"]}'
 REQ_UPDATE_NON_EXISTING = b'{"type": "update_filters", "filters": ["tototititata"]}'
 REQ_UPDATE_NO_FILTER = b'{"type": "update_filters"}'
+REQ_UPDATE_ONE_ASYNC = b'{"type": "update_filters", "filters": ["test_1"], "async": true}'
+REQ_JOB_WAIT = '{{"type": "job_wait", "job": "{}", "timeout": 20}}'
+REQ_STARTUP_TRACES = b'{"type": "startup_traces", "filters": ["test_1"]}'
 
 # Responses
 
@@ -423,6 +758,20 @@ RESP_TEST_1 = '"test_1": {"status": "running", "connections": 0, "received": 0,
 RESP_TEST_2 = '"test_2": {"status": "running", "connections": 0, "received": 0, "entryErrors": 0, "matches": 0, "failures": 0, "proc_stats": {'
 RESP_TEST_3 = '"test_3": {"status": "running", "connections": 0, "received": 0, "entryErrors": 0, "matches": 0, "failures": 0, "proc_stats": {'
 RESP_TEST_4 = '"test_4": {"status": "running", "connections": 0, "received": 0, "entryErrors": 0, "matches": 0, "failures": 0, "proc_stats": {'
+RESP_TEST_1_TIMEOUT = '"test_1": {"status": "timeout", "failures": 0}'
+RESP_TEST_2_TIMEOUT = '"test_2": {"status": "timeout", "failures": 0}'
+# Default time the filters have to send their monitoring data, in seconds
+MONITORING_TIMEOUT = 1
+RESP_TEST_1_RESTARTED = '"test_1": {"status": "running", "connections": 0, "received": 0, "entryErrors": 0, "matches": 0, "failures": 1, "proc_stats": {'
+# Time given to a failed filter to be restarted, in seconds
+RESTART_TIMEOUT = 10
+RESP_STANDBY_READY = '"standby": "ready"'
+RESP_STANDBY_UNAVAILABLE = '"standby": "unavailable"'
+# Time given to the standby instance of a filter to get ready, in seconds
+STANDBY_READY_TIMEOUT = 10
+RESP_STARTUP_TRACE_TEST_1 = '{"test_1": [{"filter": "test_1", "operation": "start", "started": '
+RESP_LATENCY_TEST_1 = '{"test_1": {"latency": {"parse": {"count": 0, "avg_ms": null, "p50_ms": null, "p95_ms": null, "p99_ms": null}, "processing": {"count": 0, "avg_ms": null, "p50_ms": null, "p95_ms": null, "p99_ms": null}, "response_write": {"count": 0, "avg_ms": null, "p50_ms": null, "p95_ms": null, "p99_ms": null}}}}'
+RESP_TEST_1_INSTANCES = '"test_1": {"status": "running", "failures": 0, "instances": {"test_1@1": {"status": "running"'
 RESP_STATUS_OK = '"status": "OK"'
 RESP_STATUS_KO = '"status": "KO"'
 RESP_ERROR_NO_PID = '"error": "PID file not accessible"'